@@ -11,4 +11,7 @@ class FelisAppConfig(AppConfig):
 
     def ready(self):
         # cannot be loaded before application is ready
-        import felis.signals
+        from felis.signals import connect_model_receivers
+        from felis.registry import build_registries
+        build_registries()
+        connect_model_receivers()
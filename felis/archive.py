@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""
+Retention of finished :model:`felis.Transaction`'s and :model:`felis.RctlSample`'s.
+
+Rows older than retention period set by FELIS_TRANSACTION_RETENTION (for each kind of transactions) and
+FELIS_RCTLSAMPLE_RETENTION are streamed to gzipped JSON-lines files in FELIS_WORK_DIR/archive and deleted
+in batches, so the table keeps the queue and the recent history only. Uncommitted transactions are never touched,
+neither are transactions :model:`felis.StateCheckpoint`'s are taken at, as states are rebuilt from them.
+"""
+
+import os
+import os.path
+import gzip
+import json
+import logging
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.core.serializers.json import DjangoJSONEncoder
+from felis.models import Transaction, RctlSample, StateCheckpoint
+
+__all__ = ['expired_transactions', 'archive_queryset', 'archive_expired']
+
+logger = logging.getLogger(__name__)
+
+
+def expired_transactions(kind, now=None):
+    """
+    Returns queryset of transactions of `kind' finished before retention period of that kind,
+    or None if transactions of that kind are kept forever. Kinds are:
+
+     * history -- committed changes that did not run a task (created with zero priority), including statistics
+       of filesystems;
+     * task -- committed changes that ran a task;
+     * rolledback -- rolled back changes.
+    """
+    retention = settings.FELIS_TRANSACTION_RETENTION.get(kind, None)
+    if retention is None:
+        return None
+    cutoff = (now or timezone.now()) - retention
+    if kind == 'history':
+        queryset = Transaction.objects.filter(Q(committed__lt=cutoff) & (Q(priority=0) | Q(priority=None)))
+    elif kind == 'task':
+        queryset = Transaction.objects.filter(Q(committed__lt=cutoff) & Q(priority__gt=0))
+    elif kind == 'rolledback':
+        queryset = Transaction.objects.filter(rolledback__lt=cutoff)
+    else:
+        raise ValueError("Unknown kind of transactions `{0}'".format(kind))
+    # deleting a transaction would cascade to checkpoints taken at it
+    return queryset.exclude(pk__in=StateCheckpoint.objects.values('transaction_id'))
+
+
+def archive_queryset(queryset, name, batch_size=None):
+    """
+    Writes rows of `queryset' to FELIS_WORK_DIR/archive/<name>-<timestamp>.jsonl.gz and deletes them, `batch_size'
+    rows at a time. Returns number of archived rows.
+    """
+    batch_size = batch_size or getattr(settings, 'FELIS_ARCHIVE_BATCH_SIZE', 1000)
+    archive_dir = os.path.join(settings.FELIS_WORK_DIR, 'archive')
+    if not os.path.isdir(archive_dir):
+        os.makedirs(archive_dir, mode=0o750, exist_ok=True)
+    path = os.path.join(archive_dir, '{0}-{1}.jsonl.gz'.format(name, timezone.now().strftime('%Y%m%d%H%M%S')))
+
+    archived = 0
+    with gzip.open(path, 'at') as archive:
+        while True:
+            # rows are deleted after they are written so every batch is taken from the head of the index
+            rows = list(queryset.order_by('pk').values()[:batch_size])
+            if not rows:
+                break
+            for row in rows:
+                archive.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            archive.flush()
+            queryset.model.objects.filter(pk__in=[row['id'] for row in rows]).delete()
+            archived += len(rows)
+    if not archived:
+        os.unlink(path)
+    logger.info('{0} rows archived to {1}'.format(archived, path))
+    return archived
+
+
+def archive_expired():
+    """
+    Archives expired transactions and resource usage samples and takes due state checkpoints of instances.
+    Meant to be run by django_q's schedule
+    """
+    now = timezone.now()
+    # checkpoints are taken before history they may be rebuilt from is archived
+    StateCheckpoint.take()
+    for kind in ('history', 'task', 'rolledback'):
+        queryset = expired_transactions(kind, now)
+        if queryset is not None:
+            archive_queryset(queryset, 'transactions-' + kind)
+
+    retention = getattr(settings, 'FELIS_RCTLSAMPLE_RETENTION', None)
+    if retention is not None:
+        archive_queryset(RctlSample.objects.filter(created__lt=now - retention), 'rctlsamples')
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+Grouping of transactions into :model:`felis.Changeset`'s.
+
+Every :model:`felis.Transaction` created inside `changeset()' context belongs to the same changeset, scheduler
+notifications are deferred until the context exits and sent once. Requests changing data are wrapped by
+:class:`ChangesetMiddleware`, management commands and scripts may use the context manager directly::
+
+    with changeset('Provisioning 50 jails'):
+        ...
+
+Changeset's row is created lazily, when the first transaction is, so contexts that change nothing leave no trace.
+"""
+
+import threading
+from contextlib import contextmanager
+
+__all__ = ['changeset', 'get_current_changeset', 'defer_notification', 'ChangesetMiddleware']
+
+_local = threading.local()
+
+
+class ChangesetScope:
+
+    def __init__(self, description='', author=None):
+        self.description = description
+        self.author = author
+        self.instance = None
+        self.notify = False
+
+    def get(self):
+        if self.instance is None:
+            from felis.models import Changeset
+            self.instance = Changeset.objects.create(description=self.description[:1024], author=self.author)
+        return self.instance
+
+
+def get_current_scope():
+    return getattr(_local, 'scope', None)
+
+
+def get_current_changeset():
+    """Returns changeset of current context creating it if needed or None if there is no changeset context"""
+    scope = get_current_scope()
+    if scope is not None:
+        return scope.get()
+
+
+def defer_notification():
+    """Returns True if scheduler notification will be sent on exit from current changeset context"""
+    scope = get_current_scope()
+    if scope is None:
+        return False
+    scope.notify = True
+    return True
+
+
+@contextmanager
+def changeset(description='', author=None):
+    """Groups transactions created inside the context into one changeset, nested contexts join the outer one"""
+    from felis.scheduler import notify_scheduler
+    if get_current_scope() is not None:
+        yield get_current_scope()
+        return
+    scope = _local.scope = ChangesetScope(description, author)
+    try:
+        yield scope
+    finally:
+        _local.scope = None
+        if scope.notify:
+            notify_scheduler()
+
+
+class ChangesetMiddleware:
+    """Wraps every request that may change data into a changeset"""
+
+    safe_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method in self.safe_methods:
+            return self.get_response(request)
+        user = getattr(request, 'user', None)
+        author = user if user is not None and user.is_authenticated else None
+        with changeset('{0} {1}'.format(request.method, request.path), author):
+            return self.get_response(request)
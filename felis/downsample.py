@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+"""
+Reducing number of points of time series before rendering.
+
+Points are (datetime, number) tuples ordered by time. Both algorithms keep the first and the last points, so the
+time range of a chart does not change.
+
+ * :func:`lttb` -- Largest-Triangle-Three-Buckets, keeps the visual shape of a line;
+ * :func:`minmax` -- keeps the minimum and the maximum of every bucket, so spikes are never lost.
+"""
+
+__all__ = ['lttb', 'minmax', 'downsample', 'METHODS']
+
+
+def _x(point):
+    return point[0].timestamp()
+
+
+def lttb(points, threshold):
+    """Returns at most `threshold' points of `points' selected by Largest-Triangle-Three-Buckets algorithm"""
+    length = len(points)
+    if threshold >= length:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]]
+
+    sampled = [points[0]]
+    # all points but the first and the last are split into threshold - 2 buckets
+    every = (length - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third vertex of triangles
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, length)
+        next_bucket = points[next_start:next_end] or [points[-1]]
+        avg_x = sum(_x(p) for p in next_bucket) / len(next_bucket)
+        avg_y = sum(p[1] for p in next_bucket) / len(next_bucket)
+
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        ax, ay = _x(points[a]), points[a][1]
+        best, best_area = start, -1
+        for j in range(start, end):
+            area = abs((ax - avg_x) * (points[j][1] - ay) - (ax - _x(points[j])) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append(points[best])
+        a = best
+    sampled.append(points[-1])
+    return sampled
+
+
+def minmax(points, threshold):
+    """Returns at most `threshold' points of `points' keeping the minimum and the maximum of every bucket"""
+    length = len(points)
+    if threshold >= length:
+        return list(points)
+    if threshold < 4:
+        # no room for a minimum and a maximum of a bucket
+        return [points[0], points[-1]]
+
+    sampled = [points[0]]
+    buckets = (threshold - 2) // 2
+    every = (length - 2) / buckets
+    for i in range(buckets):
+        bucket = points[int(i * every) + 1:int((i + 1) * every) + 1]
+        if not bucket:
+            continue
+        low = min(range(len(bucket)), key=lambda j: bucket[j][1])
+        high = max(range(len(bucket)), key=lambda j: bucket[j][1])
+        for j in sorted({low, high}):
+            sampled.append(bucket[j])
+    sampled.append(points[-1])
+    return sampled
+
+
+METHODS = {
+    'lttb': lttb,
+    'minmax': minmax,
+}
+
+
+def downsample(points, threshold, method='lttb'):
+    """Reduces `points' to at most `threshold' points with `method' (one of METHODS)"""
+    return METHODS[method](points, threshold)
@@ -46,3 +46,11 @@ class RctlUpdateFailed(FelisError):
 
 class ZfsStatUpdateFailed(FelisError):
     pass
+
+
+class TaskTimeout(TaskFailed):
+    pass
+
+
+class TaskCancelled(TaskFailed):
+    pass
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+"""
+Executors of privileged commands (zfs(8), jail(8), rctl(8), ifconfig(8), etc.).
+
+Executor class is chosen by FELIS_EXECUTOR setting:
+
+ * :class:`SudoExecutor` forks sudo(8) for every command.
+ * :class:`HelperExecutor` sends commands to a long-living privileged helper (see `manage.py felis_helper')
+   over a unix socket, so sudo's PAM and policy parsing is paid once instead of once per command.
+ * :class:`LocalExecutor` runs commands as current user, it is a drop-in fake for testing without root.
+
+Helper protocol is line-based: client sends a JSON object ``{"argv": [...], "timeout": <seconds or null>}`` and
+helper answers with a sequence of JSON objects ``{"stdout": <base64>}`` or ``{"stderr": <base64>}`` as output is
+produced, followed by ``{"returncode": <int>}`` or, if command was killed on timeout, ``{"timeout": true}``.
+The connection may then be reused for the next command. Closing the connection kills the running command.
+
+All executors kill command raising :class:`felis.errors.TaskTimeout` if it runs longer than `timeout' seconds and
+raising :class:`felis.errors.TaskCancelled` as soon as `should_cancel()' returns True.
+"""
+
+import os
+import time
+import json
+import queue
+import base64
+import socket
+import logging
+import select
+import signal
+import selectors
+import subprocess
+import socketserver
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.utils.module_loading import import_string
+from felis.errors import TaskTimeout, TaskCancelled
+
+__all__ = ['Executor', 'LocalExecutor', 'SudoExecutor', 'HelperExecutor', 'HelperServer', 'get_executor']
+
+logger = logging.getLogger('felis.models')
+
+# return code for commands rejected by helper, same as shell's "command found but not executable"
+NOT_ALLOWED = 126
+
+# how often timeouts and cancellation are checked, seconds
+POLL_INTERVAL = 1
+
+
+def check_deadline(argv, deadline, should_cancel):
+    if should_cancel is not None and should_cancel():
+        raise TaskCancelled("Command `{0}' was cancelled".format(' '.join(argv)))
+    if deadline is not None and time.monotonic() > deadline:
+        raise TaskTimeout("Command `{0}' timed out".format(' '.join(argv)))
+
+
+class Executor(ABC):
+    """Base class of executors"""
+
+    @abstractmethod
+    def stream(self, argv, on_output, timeout=None, should_cancel=None):
+        """
+        Runs command `argv' (list of strings) calling `on_output(name, data)' for every chunk of its output,
+        where `name' is 'stdout' or 'stderr'. Returns command's return code.
+        """
+
+    def run(self, argv, timeout=None, should_cancel=None):
+        """Runs command `argv' and returns a tuple of return code, stdout and stderr"""
+        output = {'stdout': list(), 'stderr': list()}
+        returncode = self.stream(argv, lambda name, data: output[name].append(data), timeout, should_cancel)
+        return returncode, b''.join(output['stdout']), b''.join(output['stderr'])
+
+
+class LocalExecutor(Executor):
+    """Runs commands as a current user"""
+
+    prefix = []
+
+    @staticmethod
+    def send_signal(p, sig):
+        # command is started in its own session, so all processes it spawned are killed too
+        try:
+            os.killpg(p.pid, sig)
+        except (ProcessLookupError, PermissionError):
+            p.send_signal(sig)
+
+    def terminate(self, p):
+        self.send_signal(p, signal.SIGTERM)
+        try:
+            p.wait(POLL_INTERVAL * 5)
+        except subprocess.TimeoutExpired:
+            self.send_signal(p, signal.SIGKILL)
+            p.wait()
+
+    def stream(self, argv, on_output, timeout=None, should_cancel=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with subprocess.Popen(
+                self.prefix + list(argv),
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                env=os.environ.copy(),
+                start_new_session=True
+        ) as p:
+            try:
+                with selectors.DefaultSelector() as selector:
+                    selector.register(p.stdout, selectors.EVENT_READ, 'stdout')
+                    selector.register(p.stderr, selectors.EVENT_READ, 'stderr')
+                    while selector.get_map():
+                        check_deadline(argv, deadline, should_cancel)
+                        for key, _events in selector.select(POLL_INTERVAL):
+                            data = os.read(key.fileobj.fileno(), 65536)
+                            if data:
+                                on_output(key.data, data)
+                            else:
+                                selector.unregister(key.fileobj)
+            except BaseException:
+                self.terminate(p)
+                raise
+            return p.wait()
+
+
+class SudoExecutor(LocalExecutor):
+    """Runs every command with sudo(8)"""
+
+    prefix = ['sudo']
+
+
+class HelperConnection:
+    """Connection to privileged helper"""
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.buffer = b''
+
+    def send(self, frame):
+        self.sock.sendall(json.dumps(frame).encode('utf-8') + b'\n')
+
+    def receive(self, timeout=None):
+        """Returns next frame or None if nothing was received in `timeout' seconds"""
+        while b'\n' not in self.buffer:
+            if not select.select([self.sock], [], [], timeout)[0]:
+                return None
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError('Helper closed connection')
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return json.loads(line.decode('utf-8'))
+
+    def close(self):
+        self.sock.close()
+
+
+class HelperExecutor(Executor):
+    """
+    Client of privileged helper. Keeps a pool of up to FELIS_HELPER_POOL_SIZE connections per process.
+    Falls back to :class:`SudoExecutor` if helper's socket does not exist.
+    """
+
+    def __init__(self, path=None, pool_size=None):
+        self.path = path or settings.FELIS_HELPER_SOCKET
+        self.pool_size = pool_size or getattr(settings, 'FELIS_HELPER_POOL_SIZE', 4)
+        self.pid = None
+        self.pool = None
+        self.fallback = SudoExecutor()
+
+    def get_pool(self):
+        # connections must not be shared with forked processes
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.pool = queue.LifoQueue(maxsize=self.pool_size)
+        return self.pool
+
+    def connect(self):
+        try:
+            return self.get_pool().get_nowait()
+        except queue.Empty:
+            return HelperConnection(self.path)
+
+    def release(self, conn):
+        try:
+            self.get_pool().put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def stream(self, argv, on_output, timeout=None, should_cancel=None):
+        if not os.path.exists(self.path):
+            logger.warning("Helper socket `{0}' does not exist, falling back to sudo".format(self.path))
+            return self.fallback.stream(argv, on_output, timeout, should_cancel)
+        conn = self.connect()
+        try:
+            conn.send({'argv': list(argv), 'timeout': timeout})
+            while True:
+                # helper kills command on timeout itself, cancellation is signalled by closing connection
+                check_deadline(argv, None, should_cancel)
+                frame = conn.receive(POLL_INTERVAL)
+                if frame is None:
+                    continue
+                if 'returncode' in frame:
+                    self.release(conn)
+                    return frame['returncode']
+                if 'timeout' in frame:
+                    self.release(conn)
+                    raise TaskTimeout("Command `{0}' timed out".format(' '.join(argv)))
+                for name in ('stdout', 'stderr'):
+                    if name in frame:
+                        on_output(name, base64.b64decode(frame[name]))
+        except TaskTimeout:
+            raise
+        except BaseException:
+            conn.close()
+            raise
+
+
+class HelperRequestHandler(socketserver.StreamRequestHandler):
+
+    def write_frame(self, **frame):
+        self.wfile.write(json.dumps(frame).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def client_gone(self):
+        if not select.select([self.connection], [], [], 0)[0]:
+            return False
+        return self.connection.recv(1, socket.MSG_PEEK) == b''
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8'))
+                argv = self.server.resolve(request['argv'])
+                timeout = request.get('timeout', None)
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                logger.warning('Helper rejected request {0}: {1}'.format(line, e))
+                self.write_frame(stderr=base64.b64encode(str(e).encode('utf-8')).decode('ascii'))
+                self.write_frame(returncode=NOT_ALLOWED)
+                continue
+            try:
+                returncode = self.server.executor.stream(
+                    argv,
+                    lambda name, data: self.write_frame(**{name: base64.b64encode(data).decode('ascii')}),
+                    timeout,
+                    self.client_gone
+                )
+            except TaskTimeout:
+                self.write_frame(timeout=True)
+                continue
+            except TaskCancelled:
+                return
+            self.write_frame(returncode=returncode)
+
+
+class HelperServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Privileged helper. Runs commands whose executable is listed in `commands' dict of {name: absolute path},
+    that is FELIS_HELPER_COMMANDS by default. Must be run as root.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path=None, commands=None, executor=None):
+        path = path or settings.FELIS_HELPER_SOCKET
+        self.commands = commands if commands is not None else settings.FELIS_HELPER_COMMANDS
+        self.executor = executor or LocalExecutor()
+        if os.path.exists(path):
+            os.unlink(path)
+        super(HelperServer, self).__init__(path, HelperRequestHandler)
+        os.chmod(path, getattr(settings, 'FELIS_HELPER_SOCKET_MODE', 0o660))
+
+    def resolve(self, argv):
+        """Returns `argv' with executable replaced by its absolute path or raises ValueError"""
+        if not argv or not all(isinstance(i, str) for i in argv):
+            raise ValueError('Command must be a non-empty list of strings')
+        if argv[0] in self.commands:
+            return [self.commands[argv[0]]] + argv[1:]
+        if argv[0] in self.commands.values():
+            return argv
+        raise ValueError("Command `{0}' is not allowed".format(argv[0]))
+
+
+_executors = dict()
+
+
+def get_executor():
+    """Returns instance of FELIS_EXECUTOR class"""
+    path = getattr(settings, 'FELIS_EXECUTOR', 'felis.executor.SudoExecutor')
+    if path not in _executors:
+        _executors[path] = import_string(path)()
+    return _executors[path]
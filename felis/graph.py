@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+"""
+Dependency graph of unfinished :model:`felis.Transaction`'s.
+
+Edges are stored in :model:`felis.TransactionDependency` and loaded with a single query, all algorithms below
+take O(nodes + edges) time, so resolving a large set of changes does not issue a query per transaction.
+"""
+
+from collections import defaultdict, deque
+
+__all__ = ['DependencyGraph']
+
+
+class DependencyGraph:
+    """
+    Directed graph where an edge (a, b) means transaction `a' waits for transaction `b' to finish.
+    `failed' is a set of finished dependencies that were rolled back.
+    """
+
+    def __init__(self, edges=(), failed=()):
+        self.nodes = set()
+        self.depends = defaultdict(set)
+        self.dependants = defaultdict(set)
+        self.failed = set(failed)
+        for transaction_id, depends_on_id in edges:
+            self.add_edge(transaction_id, depends_on_id)
+
+    @classmethod
+    def load(cls):
+        """Loads dependencies of unfinished transactions"""
+        from felis.models import TransactionDependency
+        edges = list()
+        failed = set()
+        for transaction_id, depends_on_id, rolledback in TransactionDependency.objects.filter(
+                transaction__committed=None,
+                transaction__rolledback=None,
+        ).values_list('transaction_id', 'depends_on_id', 'depends_on__rolledback'):
+            edges.append((transaction_id, depends_on_id))
+            if rolledback is not None:
+                failed.add(depends_on_id)
+        return cls(edges, failed)
+
+    def add_edge(self, transaction_id, depends_on_id):
+        self.nodes.add(transaction_id)
+        self.nodes.add(depends_on_id)
+        self.depends[transaction_id].add(depends_on_id)
+        self.dependants[depends_on_id].add(transaction_id)
+
+    def topological_order(self):
+        """
+        Returns list of nodes where every transaction follows all of its dependencies. Nodes on cycles
+        (and nodes depending on them) are not included, see `cycles'.
+        """
+        pending = {node: len(self.depends[node]) for node in self.nodes}
+        queue = deque(sorted(node for node, count in pending.items() if count == 0))
+        order = list()
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for dependant in self.dependants[node]:
+                pending[dependant] -= 1
+                if pending[dependant] == 0:
+                    queue.append(dependant)
+        return order
+
+    def cycles(self):
+        """Returns set of nodes lying on dependency cycles (or between them), such transactions never become ready"""
+        left = self.nodes - set(self.topological_order())
+        # trimming nodes that only depend on cycles but are not part of any
+        dependants = {node: len(self.dependants[node] & left) for node in left}
+        queue = deque(node for node, count in dependants.items() if count == 0)
+        while queue:
+            node = queue.popleft()
+            left.discard(node)
+            for dependency in self.depends[node] & left:
+                dependants[dependency] -= 1
+                if dependants[dependency] == 0:
+                    queue.append(dependency)
+        return left
+
+    def all_dependants(self, roots):
+        """Returns set of transactions waiting for any of `roots', directly or transitively"""
+        seen = set()
+        queue = deque(roots)
+        while queue:
+            for dependant in self.dependants[queue.popleft()]:
+                if dependant not in seen:
+                    seen.add(dependant)
+                    queue.append(dependant)
+        return seen
+
+    def doomed(self):
+        """Returns set of transactions that cannot be committed as one of their dependencies was rolled back"""
+        return self.all_dependants(self.failed)
+
+    def chain_lengths(self):
+        """
+        Returns dict of {node: number of transactions in the longest chain starting with the node and following
+        its dependants}. Starting transactions with longer chains first shortens the whole schedule.
+        """
+        lengths = dict()
+        for node in reversed(self.topological_order()):
+            lengths[node] = 1 + max((lengths.get(d, 0) for d in self.dependants[node]), default=0)
+        return lengths
+
+    def critical_path(self):
+        """Returns the longest chain of transactions waiting one for another, starting with the one to run first"""
+        lengths = self.chain_lengths()
+        if not lengths:
+            return list()
+        node = max(sorted(lengths), key=lambda n: lengths[n])
+        path = [node]
+        while self.dependants[node]:
+            candidates = [d for d in sorted(self.dependants[node]) if d in lengths]
+            if not candidates:
+                break
+            node = max(candidates, key=lambda n: lengths[n])
+            path.append(node)
+        return path
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from felis.executor import HelperServer
+
+
+class Command(BaseCommand):
+    help = 'Runs privileged helper executing whitelisted commands for felis workers. Must be run as root'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--socket', dest='socket', default=None, help='Path of unix socket to listen on')
+
+    def handle(self, *args, **options):
+        server = HelperServer(options['socket'])
+        self.stdout.write('Listening on {0}'.format(server.server_address))
+        server.serve_forever()
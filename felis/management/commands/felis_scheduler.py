@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+from django.core.management.base import BaseCommand
+from felis.scheduler import SchedulerListener
+
+
+class Command(BaseCommand):
+    help = 'Runs transactions scheduler which wakes up on database notifications'
+
+    def handle(self, *args, **options):
+        SchedulerListener().run_forever()
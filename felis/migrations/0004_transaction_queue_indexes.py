@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0003_superuser'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['committed', 'rolledback', 'started', 'priority'], name='felis_txn_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['instance', 'committed', 'rolledback', 'started'], name='felis_txn_inst_queue_idx'),
+        ),
+    ]
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0004_transaction_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RctlSample',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rctl_cputime', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_datasize', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_stacksize', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_coredumpsize', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_memoryuse', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_memorylocked', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_maxproc', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_openfiles', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_vmemoryuse', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_pseudoterminals', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_swapuse', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_nthr', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_msgqqueued', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_msgqsize', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_nmsgq', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_nsem', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_nsemop', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_nshm', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_shmsize', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_wallclock', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_pcpu', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_readbps', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_writebps', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_readiops', models.IntegerField(blank=True, editable=False, null=True)),
+                ('rctl_writeiops', models.IntegerField(blank=True, editable=False, null=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('jail', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='rctl_samples', to='felis.Jail')),
+            ],
+            options={
+                'verbose_name': 'rctl sample',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='rctlsample',
+            index=models.Index(fields=['jail', 'created'], name='felis_rctlsample_jail_idx'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Filesystem = apps.get_model('felis', 'Filesystem')
+    tree = {
+        pk: (parent_id, name, mountpoint)
+        for pk, parent_id, name, mountpoint
+        in Filesystem.objects.using(db_alias).values_list('pk', 'parent_id', 'name', 'mountpoint')
+    }
+    paths = dict()
+
+    def resolve(pk):
+        if pk not in paths:
+            parent_id, name, mountpoint = tree[pk]
+            if parent_id is None:
+                zpath, path = name, '/' + name
+            else:
+                parent_zpath, parent_path = resolve(parent_id)
+                zpath, path = parent_zpath + '/' + name, parent_path + '/' + name
+            paths[pk] = (zpath, mountpoint or path)
+        return paths[pk]
+
+    for pk in tree:
+        zpath, path = resolve(pk)
+        Filesystem.objects.using(db_alias).filter(pk=pk).update(zpath=zpath, path=path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0005_rctlsample'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filesystem',
+            name='zpath',
+            field=models.CharField(db_index=True, default='', editable=False, help_text='ZFS path of filesystem', max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='filesystem',
+            name='path',
+            field=models.CharField(default='', editable=False, help_text='Unix path of mounted filesystem', max_length=1024),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+    ]
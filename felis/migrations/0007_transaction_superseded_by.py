@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0006_filesystem_materialized_paths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transaction',
+            name='superseded_by',
+            field=models.ForeignKey(
+                blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL,
+                related_name='supersedes', to='felis.Transaction'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0007_transaction_superseded_by'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StateCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('state', django.contrib.postgres.fields.jsonb.JSONField()),
+                ('instance', models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='felis.Model')),
+                ('transaction', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='felis.Transaction')),
+            ],
+            options={
+                'verbose_name': 'State checkpoint',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='statecheckpoint',
+            index=models.Index(fields=['instance', 'transaction'], name='felis_checkpoint_idx'),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import arrow
+from django.db import migrations
+
+ARCHIVE_TASK_NAME = 'Archive expired transactions and resource usage samples'
+
+
+def create_scheduled_task(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Schedule = apps.get_model("django_q", "Schedule")
+
+    # task to archive finished transactions older than FELIS_TRANSACTION_RETENTION
+    Schedule.objects.using(db_alias).create(
+        name=ARCHIVE_TASK_NAME,
+        func='felis.archive.archive_expired',
+        schedule_type='D',
+        repeats=-1,
+        next_run=arrow.utcnow().replace(hour=3, minute=30, second=0).shift(days=1).datetime
+    )
+
+
+def delete_scheduled_task(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Schedule = apps.get_model("django_q", "Schedule")
+    Schedule.objects.using(db_alias).filter(name=ARCHIVE_TASK_NAME).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0008_statecheckpoint'),
+        ('django_q', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_scheduled_task, delete_scheduled_task),
+        # unfinished transactions are a tiny part of the table, indexing them separately keeps the scheduler's
+        # working set in memory however large the history grows
+        migrations.RunSQL(
+            'CREATE INDEX felis_txn_unfinished_idx ON felis_transaction (instance_id, priority) '
+            'WHERE committed IS NULL AND rolledback IS NULL',
+            'DROP INDEX felis_txn_unfinished_idx',
+        ),
+    ]
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from django.conf import settings
+import django.contrib.postgres.fields.jsonb
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_q', '0001_initial'),
+        ('felis', '0009_transaction_retention'),
+    ]
+
+    operations = [
+        # replaced by partial indexes below
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='felis_txn_queue_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='felis_txn_inst_queue_idx',
+        ),
+
+        # single-column indexes never used alone or covered by composite indexes
+        migrations.AlterField(
+            model_name='transaction',
+            name='instance',
+            field=models.ForeignKey(blank=True, db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='transactions', to='felis.Model'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='change_type',
+            field=models.PositiveSmallIntegerField(choices=[(0, 'CREATE'), (1, 'UPDATE'), (2, 'DELETE')]),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='started',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='committed',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='rolledback',
+            field=models.DateTimeField(blank=True, default=None, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='value',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='task',
+            field=models.OneToOneField(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='transaction', to='django_q.Task'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='depends',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='_transaction_depends_+', to='felis.Transaction'),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='priority',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='author',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['instance', 'created'], name='felis_txn_inst_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['author', 'rolledback'], name='felis_txn_author_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['value'], name='felis_txn_value_gin'),
+        ),
+
+        # pending transactions in order they are started by scheduler, see felis.tasks.ready_transactions
+        migrations.RunSQL(
+            'CREATE INDEX felis_txn_pending_idx ON felis_transaction (priority DESC, id) '
+            'WHERE committed IS NULL AND rolledback IS NULL AND started IS NULL AND priority > 0',
+            'DROP INDEX felis_txn_pending_idx',
+        ),
+        # running transactions by instance, see felis.tasks.claim_transactions and stalled_transactions
+        migrations.RunSQL(
+            'CREATE INDEX felis_txn_running_idx ON felis_transaction (instance_id, started) '
+            'WHERE committed IS NULL AND rolledback IS NULL AND started IS NOT NULL AND priority > 0',
+            'DROP INDEX felis_txn_running_idx',
+        ),
+        # covered by the two indexes above
+        migrations.RunSQL(
+            'DROP INDEX IF EXISTS felis_txn_unfinished_idx',
+            'CREATE INDEX felis_txn_unfinished_idx ON felis_transaction (instance_id, priority) '
+            'WHERE committed IS NULL AND rolledback IS NULL',
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0010_transaction_index_review'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransactionDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depends_on', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependant_edges', to='felis.Transaction')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dependency_edges', to='felis.Transaction')),
+            ],
+            options={
+                'verbose_name': 'Transaction dependency',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='transactiondependency',
+            unique_together=set([('transaction', 'depends_on')]),
+        ),
+        # symmetrical table stores every edge in both directions, only the one pointing to the transaction
+        # of higher priority was ever taken into account by scheduler
+        migrations.RunSQL(
+            'INSERT INTO felis_transactiondependency (transaction_id, depends_on_id) '
+            'SELECT d.from_transaction_id, d.to_transaction_id FROM felis_transaction_depends d '
+            'JOIN felis_transaction f ON f.id = d.from_transaction_id '
+            'JOIN felis_transaction t ON t.id = d.to_transaction_id '
+            'WHERE t.priority > f.priority',
+            'INSERT INTO felis_transaction_depends (from_transaction_id, to_transaction_id) '
+            'SELECT transaction_id, depends_on_id FROM felis_transactiondependency UNION '
+            'SELECT depends_on_id, transaction_id FROM felis_transactiondependency',
+        ),
+        migrations.RemoveField(
+            model_name='transaction',
+            name='depends',
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='depends',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='dependants', through='felis.TransactionDependency', to='felis.Transaction'),
+        ),
+    ]
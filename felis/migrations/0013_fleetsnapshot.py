@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('felis', '0012_changeset'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FleetSnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField()),
+            ],
+            options={
+                'verbose_name': 'fleet snapshot',
+            },
+        ),
+    ]
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from .transaction import *
+from .changeset import *
 from .jail import *
 from .net import *
 from .rctl import *
@@ -8,7 +9,7 @@ from .zfs import *
 from .auth import *
 
 __all__ = [
-    'Model', 'Filesystem', 'Snapshot', 'Clone', 'World', 'Jail',
-    'Interface', 'IPAddress', 'Skel', 'Transaction', 'RctlRule',
-    'UserPreferences'
+    'Model', 'StateCheckpoint', 'Filesystem', 'Snapshot', 'Clone', 'World', 'Jail',
+    'Interface', 'IPAddress', 'Skel', 'Transaction', 'TransactionDependency', 'Changeset', 'RctlRule', 'RctlSample',
+    'FleetSnapshot', 'UserPreferences'
 ]
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+from django.db import models
+from django.conf import settings
+
+__all__ = ['Changeset']
+
+
+class Changeset(models.Model):
+    """
+    Group of :model:`felis.Transaction`'s created during one request, API call or management command
+    (see :mod:`felis.changeset`). Scheduler is woken up once per changeset, progress of its transactions
+    is reported as a whole and at most FELIS_CHANGESET_CONCURRENCY of them are run simultaneously.
+    """
+
+    class Meta:
+        verbose_name = 'Changeset'
+        ordering = ['-pk']
+
+    created = models.DateTimeField(auto_now_add=True)
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    description = models.CharField(max_length=1024, blank=True, default='')
+
+    @property
+    def progress(self):
+        """Returns dict of numbers of changeset's transactions by their state, counted with a single query"""
+        unfinished = models.Q(committed=None) & models.Q(rolledback=None)
+        counts = self.transactions.aggregate(
+            total=models.Count('pk'),
+            pending=models.Count(models.Case(models.When(unfinished & models.Q(started=None), then=1))),
+            running=models.Count(models.Case(models.When(unfinished & ~models.Q(started=None), then=1))),
+            committed=models.Count(models.Case(models.When(~models.Q(committed=None), then=1))),
+            rolledback=models.Count(models.Case(models.When(~models.Q(rolledback=None), then=1))),
+        )
+        counts['finished'] = counts['pending'] == 0 and counts['running'] == 0
+        return counts
+
+    def __str__(self):
+        return 'changeset #{0}: {1}'.format(self.pk, self.description)
@@ -74,6 +74,9 @@ class World(Filesystem, WorldFSMMixin):
 
     # Tasks
 
+    # building world takes hours, output of scripts is streamed to transaction's log
+    task_update_status_timeout = 4 * 3600
+
     def task_update_status_updated_updating(self, t):
         self.status = self.UPDATING_SRC
 
@@ -81,7 +84,7 @@ class World(Filesystem, WorldFSMMixin):
 
     def task_update_status_updating_updating_src(self, t):
         try:
-            t.exec(self.scriptpath+' updatesrc')
+            t.exec(self.scriptpath+' updatesrc', stream=True)
             self.status = self.BUILDING_WORLD
         except BaseException as e:
             logger.exception('Cannot update world sources for world {0}: {1}'.format(self, e))
@@ -89,7 +92,7 @@ class World(Filesystem, WorldFSMMixin):
 
     def task_update_status_updating_src_building_world(self, t):
         try:
-            t.exec(self.scriptpath+' buildworld')
+            t.exec(self.scriptpath+' buildworld', stream=True)
             self.status = self.PACKAGING_WORLD
         except BaseException as e:
             logger.exception('Cannot build world {0}: {1}'.format(self, e))
@@ -97,7 +100,7 @@ class World(Filesystem, WorldFSMMixin):
 
     def task_update_status_building_world_packaging_world(self, t):
         try:
-            t.exec(self.scriptpath+' packageworld')
+            t.exec(self.scriptpath+' packageworld', stream=True)
             self.status = self.INSTALLING_WORLD
         except BaseException as e:
             logger.exception('Cannot package world {0}: {1}'.format(self, e))
@@ -114,7 +117,7 @@ class World(Filesystem, WorldFSMMixin):
                 if self.jails.filter(~models.Q(status=Jail.STOPPED)).first():
                     logger.critical("Jails {0} have been stopped, but world {1} updating failed".format(jails, self))
                     raise WorldError('World {0} updating failed as jails refuses to stop.')
-            t.exec(self.scriptpath+' installworld')
+            t.exec(self.scriptpath+' installworld', stream=True)
             self.status = self.CLEANING_UP
         except BaseException as e:
             logger.exception('Cannot install world {0}: {1}'.format(self, e))
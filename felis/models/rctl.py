@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import heapq
 from functools import reduce
+from collections import defaultdict
+from logging import getLogger
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.db import models
+from django.contrib.postgres.fields import JSONField
 from .transaction import Model
 from felis.errors import *
 
-__all__ = ['RctlMixin', 'RctlRule']
+__all__ = ['RctlMixin', 'RctlRule', 'RctlSample', 'FleetSnapshot']
+
+logger = getLogger('felis.models')
 
 rctls = [
     # rctl(8) resource   rctl(8) possible action for resource
@@ -81,18 +91,186 @@ def _rctl_mixin_model_generator():
 
 RctlMixin = _rctl_mixin_model_generator()
 
-def update_current_rctls():
-    from .jail import Jail
+class RctlSample(RctlMixin):
+    """
+    Resource usage of a running :model:`felis.Jail` collected by `update_current_rctls'.
+
+    Samples are telemetry, so they are stored apart from :model:`felis.Transaction` and bypass signals entirely.
+    """
+
+    class Meta:
+        verbose_name = 'rctl sample'
+        indexes = [
+            models.Index(fields=['jail', 'created'], name='felis_rctlsample_jail_idx'),
+        ]
+
+    jail = models.ForeignKey('felis.Jail', related_name='rctl_samples', on_delete=models.CASCADE, db_index=False)
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    # time of the latest sample of each jail, rendered charts are keyed by it
+    cache = caches['chart']
+
+    @staticmethod
+    def latest_key(jail_id):
+        return 'rctl_sample:{0}'.format(jail_id)
+
+    @classmethod
+    def latest(cls, jail_id):
+        """Returns time of the latest sample of jail, it is cached by `update_current_rctls' on collection"""
+        created = cls.cache.get(cls.latest_key(jail_id), None)
+        if created is None:
+            created = cls.objects.filter(jail_id=jail_id).aggregate(models.Max('created'))['created__max']
+            if created is not None:
+                cls.cache.set(cls.latest_key(jail_id), created)
+        return created
+
+    def __str__(self):
+        return 'rctl sample #{0} of jail #{1} at {2}'.format(self.pk, self.jail_id, self.created)
+
+
+class FleetSnapshot(models.Model):
+    """
+    Resource usage of all running jails aggregated by `update_current_rctls' on every collection: top consumers
+    of each resource, totals per skel, per world and for the whole host (see `fleet_snapshot' for the format).
+    Only the latest snapshot is kept, so the fleet overview is read with one query whatever number of jails.
+    """
+
+    class Meta:
+        verbose_name = 'fleet snapshot'
+
+    created = models.DateTimeField(default=timezone.now, editable=False)
+    data = JSONField()
+
+    @classmethod
+    def store(cls, data, created):
+        cls.objects.update_or_create(pk=1, defaults={'data': data, 'created': created})
+
+    @classmethod
+    def current(cls):
+        return cls.objects.filter(pk=1).first()
+
+    def __str__(self):
+        return 'fleet snapshot at {0}'.format(self.created)
+
+
+def fleet_snapshot(rows, jails, skel_names, world_names, top=None):
+    """
+    Aggregates collected resource usage. `rows' is {jail id: {'rctl_<resource>': amount}}, `jails' is
+    {jail id: (name, skel id, world id)}, `skel_names' and `world_names' are {id: name}. Returns dict of
+
+     * host -- {resource: total};
+     * top -- {resource: [[jail id, jail name, amount], ...]} of `top' (FELIS_FLEET_TOP_N) largest consumers;
+     * skels, worlds -- lists of {'id', 'name', 'jails', 'totals': {resource: total}}.
+    """
+    top = top or getattr(settings, 'FELIS_FLEET_TOP_N', 10)
+    resources = [rctl[0] for rctl in rctls]
+    host = dict.fromkeys(resources, 0)
+    groups = {'skels': defaultdict(lambda: dict.fromkeys(resources, 0)),
+              'worlds': defaultdict(lambda: dict.fromkeys(resources, 0))}
+    counts = {'skels': defaultdict(int), 'worlds': defaultdict(int)}
+    consumers = defaultdict(list)
+    for pk, row in rows.items():
+        name, skel_id, world_id = jails[pk]
+        counts['skels'][skel_id] += 1
+        counts['worlds'][world_id] += 1
+        for resource in resources:
+            amount = row.get('rctl_' + resource, None)
+            if amount is None:
+                continue
+            host[resource] += amount
+            groups['skels'][skel_id][resource] += amount
+            groups['worlds'][world_id][resource] += amount
+            consumers[resource].append((amount, pk, name))
+
+    snapshot = {
+        'jails': len(rows),
+        'host': host,
+        'top': {
+            resource: [[pk, name, amount] for amount, pk, name in heapq.nlargest(top, consumers[resource])]
+            for resource in resources
+        },
+    }
+    for kind, names in (('skels', skel_names), ('worlds', world_names)):
+        snapshot[kind] = [
+            {'id': pk, 'name': names.get(pk, None), 'jails': counts[kind][pk], 'totals': groups[kind][pk]}
+            for pk in sorted(counts[kind], key=lambda pk: (pk is None, pk))
+        ]
+    return snapshot
+
+
+def parse_rctl_usage(output):
+    """Parses output of `rctl -u' into dict of {resource: amount} for resources known to felis"""
+    resources = {rctl[0] for rctl in rctls}
+    usage = dict()
+    for line in output.split(b'\n'):
+        if line.strip():
+            resource, amount = line.split(b'=')
+            if resource.decode('utf-8') in resources:
+                usage[resource.decode('utf-8')] = int(amount)
+    return usage
+
+
+def collect_rctl_usage(jail_names, workers=None):
+    """
+    Runs `rctl -u' for every jail in a bounded pool of FELIS_RCTL_COLLECT_WORKERS threads.
+    Returns a tuple of dicts keyed by jail name: usage of collected jails and errors of failed ones.
+    """
     from felis.utils import run_shell_command
-    for jail in Jail.objects.filter(status=Jail.RUNNING):
-        errcode, stdout, stderr = run_shell_command("rctl -u jail:{0}".format(jail.name))
+
+    def collect(jail_name):
+        errcode, stdout, stderr = run_shell_command("rctl -u jail:{0}".format(jail_name))
         if errcode != 0:
-            raise RctlUpdateFailed()
-        for line in stdout.split(b'\n'):
-            if line.strip():
-                resource, amount = line.split(b'=')
-                setattr(jail, 'rctl_'+resource.decode('utf-8'), int(amount))
-        jail.save()
+            raise RctlUpdateFailed(stderr.decode('utf-8', 'replace').strip())
+        return parse_rctl_usage(stdout)
+
+    usage = dict()
+    failures = dict()
+    if not jail_names:
+        return usage, failures
+    workers = workers or getattr(settings, 'FELIS_RCTL_COLLECT_WORKERS', 8)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(collect, jail_name): jail_name for jail_name in jail_names}
+        for future in as_completed(futures):
+            try:
+                usage[futures[future]] = future.result()
+            except BaseException as e:
+                failures[futures[future]] = e
+    return usage, failures
+
+
+def update_current_rctls():
+    from .jail import Jail, Skel, World
+    from felis.utils import bulk_update
+    running = {
+        pk: (name, skel_id, world_id)
+        for pk, name, skel_id, world_id in Jail.objects.filter(status=Jail.RUNNING).values_list(
+            'pk', 'name', 'base_id', 'world_template_id')
+    }
+    jails = {name: pk for pk, (name, _skel_id, _world_id) in running.items()}
+    usage, failures = collect_rctl_usage(list(jails.keys()))
+    for jail_name, error in failures.items():
+        logger.error("Cannot collect resource usage of jail `{0}': {1}".format(jail_name, error))
+
+    created = timezone.now()
+    rows = {
+        jails[jail_name]: {'rctl_' + resource: amount for resource, amount in jail_usage.items()}
+        for jail_name, jail_usage in usage.items()
+    }
+    RctlSample.objects.bulk_create([RctlSample(jail_id=pk, created=created, **row) for pk, row in rows.items()])
+    # new keys make charts of these jails rendered again
+    RctlSample.cache.set_many({RctlSample.latest_key(pk): created for pk in rows})
+    # current usage is stored in jails' rows directly as it is not a change that needs a transaction
+    bulk_update(Jail, rows, ['rctl_' + rctl[0] for rctl in rctls])
+
+    skel_ids = {skel_id for _name, skel_id, _world_id in running.values()}
+    world_ids = {world_id for _name, _skel_id, world_id in running.values()}
+    FleetSnapshot.store(fleet_snapshot(
+        rows,
+        running,
+        dict(Skel.objects.filter(pk__in=skel_ids).values_list('pk', 'name')),
+        dict(World.objects.filter(pk__in=world_ids).values_list('pk', 'name')),
+    ), created)
+    return sorted(failures.keys())
 
 
 class RctlRule(Model):
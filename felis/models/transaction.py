@@ -1,22 +1,29 @@
 # -*- coding: utf-8 -*-
 
 import logging
+from datetime import timedelta
 import django.db.models as models
+from django.db.models.functions import Coalesce
 from django.utils import timezone
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.contenttypes.models import ContentType
 from django.core.cache import caches
 from django_q.models import Task
 from polymorphic.models import PolymorphicModel
 from felis.errors import *
 
-__all__ = ['Transaction', 'Model']
+__all__ = ['Transaction', 'TransactionDependency', 'StateCheckpoint', 'Model']
 
 logger = logging.getLogger('felis.models')
 
+# started transactions not finished in this time are rolled back by scheduler, it must be longer than
+# the longest `<task name>_timeout' (checked by felis.registry) so that commands are killed by their own timeout first
+TRANSACTION_COMMIT_TIMEOUT = timedelta(hours=8)
+
 class Transaction(models.Model):
     """
     Represents a change or set of changes in a :model:`felis.Model`'s instance that may require executing some tasks.
@@ -26,32 +33,55 @@ class Transaction(models.Model):
     class Meta:
         verbose_name = 'Transaction'
         ordering = ["-pk"]
+        # scheduler's queue lookups (see felis.tasks) use partial indexes of unfinished, pending and running
+        # transactions created by migrations as Index cannot have a condition
+        indexes = [
+            # history of instance (charts, previous/next transactions)
+            models.Index(fields=['instance', 'created'], name='felis_txn_inst_created_idx'),
+            # failed transactions of user (home page)
+            models.Index(fields=['author', 'rolledback'], name='felis_txn_author_idx'),
+            # filtering on keys of `value' (`value__has_key')
+            GinIndex(fields=['value'], name='felis_txn_value_gin'),
+        ]
 
     cache = caches['transaction']
 
+    # bytes of stderr kept in memory for error message when output is streamed to log
+    STDERR_TAIL = 4096
+
     CREATE = 0
     UPDATE = 1
     DELETE = 2
 
     instance = models.ForeignKey(
         'Model', related_name='transactions', on_delete=models.SET_NULL,
-        null=True, db_index=True, blank=True, editable=False)
+        null=True, db_index=False, blank=True, editable=False)
     content_type = models.ForeignKey(ContentType, null=True, db_index=True, blank=True)
 
     change_type = models.PositiveSmallIntegerField(
         choices=((CREATE, 'CREATE'), (UPDATE, 'UPDATE'), (DELETE, 'DELETE')),
-        db_index=True
     )
 
     created = models.DateTimeField(auto_now_add=True)
-    started = models.DateTimeField(null=True, default=None, db_index=True, blank=True)
-    committed = models.DateTimeField(null=True, default=None, db_index=True, blank=True)
-    rolledback = models.DateTimeField(null=True, default=None, db_index=True, blank=True)
-    value = JSONField(null=True, db_index=True, blank=True)
-    task = models.OneToOneField(Task, related_name='transaction', null=True, db_index=True, blank=True, editable=False)
-    depends = models.ManyToManyField('self', symmetrical=True, db_index=True, blank=True, editable=False)
-    priority = models.PositiveSmallIntegerField(db_index=True, null=True, blank=True)
-    author = models.ForeignKey(settings.AUTH_USER_MODEL, db_index=True, null=True, blank=True)
+    started = models.DateTimeField(null=True, default=None, blank=True)
+    committed = models.DateTimeField(null=True, default=None, blank=True)
+    rolledback = models.DateTimeField(null=True, default=None, blank=True)
+    value = JSONField(null=True, blank=True)
+    task = models.OneToOneField(Task, related_name='transaction', null=True, blank=True, editable=False)
+    # transactions that must be finished before this one is started, see felis.graph
+    depends = models.ManyToManyField(
+        'self', symmetrical=False, through='TransactionDependency', through_fields=('transaction', 'depends_on'),
+        related_name='dependants', blank=True, editable=False)
+    priority = models.PositiveSmallIntegerField(null=True, blank=True)
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, db_index=False, null=True, blank=True)
+    changeset = models.ForeignKey(
+        'Changeset', related_name='transactions', on_delete=models.SET_NULL,
+        null=True, blank=True, editable=False)
+    # pending transaction that applies the final value of the same field instead of this one,
+    # see felis.tasks.coalesce_transactions
+    superseded_by = models.ForeignKey(
+        'self', related_name='supersedes', on_delete=models.SET_NULL,
+        null=True, blank=True, editable=False)
 
     def full_clean(self, *args, **kwargs):
         # transaction cannot be committed and rolledback simultaneously
@@ -96,33 +126,47 @@ class Transaction(models.Model):
 
     @property
     def old_values_dict(self):
+        """Values of instance's fields before this transaction, None for CREATE"""
         cached_values = self.cache.get(self.pk, dict())
         if cached_values and 'old' in cached_values:
             return cached_values['old']
-        d = None
-        if self.new_values_dict:
-            d ={**self.new_values_dict, **self.value}
-        if d is None and self.instance:
-            d = {**self.instance.as_dict(), **self.value}
-        if d is not None:
-            self.cache.set(self.pk, {**cached_values, 'old': d})
+        if self.change_type == self.CREATE:
+            d = None
+        elif self.change_type == self.DELETE:
+            d = self.value
+        else:
+            d = {**self.new_values_dict, **self.value}
+        self.cache.set(self.pk, {**self.cache.get(self.pk, dict()), 'old': d})
         return d
 
     @property
     def new_values_dict(self):
+        """
+        Values of instance's fields right after this transaction, None for DELETE. Cached values are used if any,
+        otherwise state is rebuilt from the nearest later :model:`felis.StateCheckpoint` (or the current state of
+        instance if there is none) by reverting changes of transactions made after this one. As checkpoints are
+        taken every FELIS_CHECKPOINT_INTERVAL transactions, this takes a bounded number of queries and rows.
+        """
         cached_values = self.cache.get(self.pk, dict())
         if cached_values and 'new' in cached_values:
             return cached_values['new']
-        d = None
-        if ('cached' in self.next.cached_data) or \
-                ('cached' in self.next.next.cached_data) or \
-                ('cached' in self.next.next.next.cached_data):
-                d = {**self.next.new_values_dict, **self.next.value}
-        if d is not None:
-            self.cache.set(self.pk, {**cached_values, 'new': d, 'cached': True})
-        # cached values to far from this transaction
-        if d is None:
-            d = self.instance.as_dict()
+        if self.change_type == self.DELETE or self.instance_id is None:
+            return None
+
+        checkpoint = StateCheckpoint.objects.filter(
+            instance_id=self.instance_id, transaction_id__gte=self.pk
+        ).order_by('transaction_id').values_list('transaction_id', 'state').first()
+        if checkpoint is not None:
+            last, d = checkpoint
+            later = Transaction.objects.filter(instance_id=self.instance_id, pk__gt=self.pk, pk__lte=last)
+        else:
+            d = self.content_type.get_object_for_this_type(pk=self.instance_id).as_dict()
+            later = Transaction.objects.filter(instance_id=self.instance_id, pk__gt=self.pk)
+        # `value' holds fields' values preceding a transaction, so applying them in reverse order rolls state back
+        for value in later.exclude(value=None).order_by('-pk').values_list('value', flat=True):
+            d.update(value)
+
+        self.cache.set(self.pk, {**cached_values, 'new': d})
         return d
 
     @property
@@ -135,6 +179,18 @@ class Transaction(models.Model):
         if self.value:
             return list(self.value.keys())
 
+    @property
+    def coalescible(self):
+        """
+        Whether this transaction may be merged with other pending ones updating the same field. Tasks that only apply
+        the current value of a field may be coalesced, set `task_update_<field>_coalesce' to False otherwise.
+        """
+        from felis.registry import get_registry
+        if self.change_type != self.UPDATE or not self.field or self.content_type_id is None:
+            return False
+        model = ContentType.objects.get_for_id(self.content_type_id).model_class()
+        return self.field in get_registry(model).coalescible_fields
+
     @property
     def task_name(self):
         if self.change_type == self.CREATE:
@@ -161,29 +217,20 @@ class Transaction(models.Model):
                 setattr(instance, field.name, None)
         return instance
 
+    @property
+    def model(self):
+        """Class of instance, known even if instance has been deleted"""
+        if self.instance is not None:
+            return type(self.instance)
+        if self.content_type_id is not None:
+            return ContentType.objects.get_for_id(self.content_type_id).model_class()
+
     def get_priority(self):
+        from felis.registry import get_registry
         if self.instance is None and self.change_type != self.DELETE:
             # empty priority, will never execute
             return 0
-        if self.change_type == self.CREATE:
-            if hasattr(self.instance, 'task_create_priority'):
-                return self.instance.task_create_priority
-            else:
-                # default for CREATE task
-                return 100
-        elif self.change_type == self.UPDATE:
-            if self.field:
-                if hasattr(self.instance, 'task_update_'+self.field):
-                    return getattr(self.instance, 'task_update_'+self.field+'_priority')
-            # default for UPDATE task
-            return 50
-        elif self.change_type == self.DELETE:
-            if hasattr(self.instance, 'task_delete_priority'):
-                return self.instance.task_delete_priority
-            else:
-                # default for DELETE task
-                return 90
-
+        return get_registry(self.model).priority(self.change_type, self.field)
 
     def render_command(self, command):
         """Replaces curly-braced words in `command' with values of corresponding models fields"""
@@ -198,27 +245,67 @@ class Transaction(models.Model):
             if i is not None and i[1] is not None
             })
 
-    def exec(self, command):
-        import subprocess
+    @property
+    def timeout(self):
+        """Seconds task's commands may run, set by `<task name>_timeout' attribute of instance"""
+        return getattr(self.instance, str(self.task_name) + '_timeout', settings.FELIS_EXEC_TIMEOUT)
+
+    @property
+    def cancel_key(self):
+        return 'felis:transaction:{0}:cancel'.format(self.pk)
+
+    def cancel(self):
+        """Asks running task to kill its command. The task fails and transaction is rolled back"""
+        caches['default'].set(self.cancel_key, True, int(TRANSACTION_COMMIT_TIMEOUT.total_seconds()))
+
+    def is_cancelled(self):
+        return bool(caches['default'].get(self.cancel_key, False))
+
+    @property
+    def log(self):
+        from felis.tasklog import TaskLog
+        return TaskLog(self.pk)
+
+    def exec(self, command, stream=False, timeout=None):
+        """
+        Runs `command' rendered with `render_command' and returns tuple of its stdout and stderr.
+        If `stream' is True the output is written to transaction's log as it is produced rather than
+        kept in memory and only last STDERR_TAIL bytes of stderr are returned. Command is killed if it runs longer
+        than `timeout' seconds (transaction's `timeout' by default) or transaction is cancelled.
+        """
         import shlex
-        import os
+        from felis.executor import get_executor
         if command:
             rendered_command = self.render_command(command)
+            argv = shlex.split(rendered_command)
+            timeout = self.timeout if timeout is None else timeout
             logger.info('Running command {0}'.format(rendered_command))
-            with subprocess.Popen(
-                            ['sudo'] + shlex.split(rendered_command),
-                    stdin=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    env=os.environ.copy()
-            ) as p:
-                stdout, stderr = p.communicate()
-                if p.returncode != 0:
-                    raise TaskFailed("Execution of command `{0}' failed with errorcode {1}: {2}".format(
-                        rendered_command, p.returncode, stderr))
-                return stdout, stderr
-
-    def commit(self):
+            if stream:
+                stderr = bytearray()
+
+                def on_output(name, data):
+                    log.write(data)
+                    if name == 'stderr':
+                        stderr.extend(data)
+                        del stderr[:-self.STDERR_TAIL]
+
+                with self.log as log:
+                    log.write('$ {0}\n'.format(rendered_command).encode('utf-8'))
+                    returncode = get_executor().stream(argv, on_output, timeout, self.is_cancelled)
+                stdout, stderr = b'', bytes(stderr)
+            else:
+                returncode, stdout, stderr = get_executor().run(argv, timeout, self.is_cancelled)
+            if returncode != 0:
+                raise TaskFailed("Execution of command `{0}' failed with errorcode {1}: {2}".format(
+                    rendered_command, returncode, stderr))
+            return stdout, stderr
+
+    def commit(self, applied=False):
+        """
+        Runs transaction's task and marks transaction committed, or rolls it back if the task fails.
+        If `applied', the change was already made by other means (e.g. by a batched command, see
+        felis.tasks.commit_zfs_set_batch) and the task is not run.
+        """
         logger.info("Executing task for \n"
                     "{transaction}:\n"
                     "instance\t=\t{instance}\n"
@@ -261,7 +348,8 @@ class Transaction(models.Model):
         logger.debug("Getting attribute `{0}' of instance `{1}' and calling it with params `{2}'".format(
             self.task_name, instance, self))
         try:
-            getattr(instance, self.task_name)(self)
+            if not applied:
+                getattr(instance, self.task_name)(self)
             logger.debug("Committing changes for {0}".format(self))
             self.committed = timezone.now()
         except BaseException as e:
@@ -289,12 +377,90 @@ class Transaction(models.Model):
         else:
             # DELETE cannot be rolledback
             pass
+        # superseded transactions were never applied on their own, their values are reverted together with this one
+        self.supersedes.update(committed=None, rolledback=self.rolledback)
         self.save(force_update=True)
 
     def __str__(self):
         return "Transaction #{0} for instance `{1}'".format(self.id, self.instance)
 
 
+class TransactionDependency(models.Model):
+    """Directed edge of dependency graph: `transaction' may not be started until `depends_on' is finished"""
+
+    class Meta:
+        verbose_name = 'Transaction dependency'
+        unique_together = (('transaction', 'depends_on'),)
+
+    transaction = models.ForeignKey(Transaction, related_name='dependency_edges', on_delete=models.CASCADE)
+    depends_on = models.ForeignKey(Transaction, related_name='dependant_edges', on_delete=models.CASCADE)
+
+    def __str__(self):
+        return "Transaction #{0} depends on transaction #{1}".format(self.transaction_id, self.depends_on_id)
+
+
+class StateCheckpoint(models.Model):
+    """
+    Full state of a :model:`felis.Model`'s instance right after a :model:`felis.Transaction`.
+    Taken every FELIS_CHECKPOINT_INTERVAL transactions of instance (see `take'), used to rebuild
+    historical states without walking the whole chain of transactions.
+    """
+
+    class Meta:
+        verbose_name = 'State checkpoint'
+        indexes = [
+            models.Index(fields=['instance', 'transaction'], name='felis_checkpoint_idx'),
+        ]
+
+    instance = models.ForeignKey(
+        'Model', related_name='checkpoints', on_delete=models.CASCADE, db_index=False, editable=False)
+    transaction = models.ForeignKey(
+        Transaction, related_name='checkpoints', on_delete=models.CASCADE, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    state = JSONField()
+
+    @classmethod
+    def take(cls, states=None, force=False):
+        """
+        Takes checkpoints of instances in `states' dict of {instance id: state after the latest transaction}
+        which had at least FELIS_CHECKPOINT_INTERVAL transactions since their last checkpoint (or any if `force').
+        State may be None, then it is taken from the instance. If `states' is None all instances are checked.
+        Number of queries does not depend on the number of instances.
+
+        The first checkpoint is taken when an instance is created (see `felis.signals'). Later ones are not taken on
+        save, but by collection of filesystems' statistics for its instances and by `felis.archive.archive_expired'
+        for all others.
+        """
+        if states is not None and not states:
+            return list()
+        interval = 1 if force else getattr(settings, 'FELIS_CHECKPOINT_INTERVAL', 100)
+        last_checkpoint = cls.objects.filter(
+            instance=models.OuterRef('instance')
+        ).order_by('-transaction_id').values('transaction_id')[:1]
+        rows = Transaction.objects.filter(
+            pk__gt=Coalesce(
+                models.Subquery(last_checkpoint, output_field=models.IntegerField()), models.Value(0))
+        )
+        if states is None:
+            rows = rows.exclude(instance=None)
+            states = dict()
+        else:
+            rows = rows.filter(instance_id__in=states.keys())
+        rows = list(rows.order_by().values('instance_id').annotate(
+            count=models.Count('pk'), latest=models.Max('pk')
+        ).filter(count__gte=interval))
+        missing = [row['instance_id'] for row in rows if states.get(row['instance_id'], None) is None]
+        if missing:
+            states = {**states, **{i.pk: i.as_dict() for i in Model.objects.filter(pk__in=missing)}}
+        return cls.objects.bulk_create([
+            cls(instance_id=row['instance_id'], transaction_id=row['latest'], state=states[row['instance_id']])
+            for row in rows
+        ])
+
+    def __str__(self):
+        return "State checkpoint of instance #{0} at transaction #{1}".format(self.instance_id, self.transaction_id)
+
+
 class Model(PolymorphicModel):
     """
     An abstract model to inherit for every model that may require execute some python code or shell commands on
@@ -325,31 +491,9 @@ class Model(PolymorphicModel):
     # name = models.CharField(max_length=1024, blank=False, null=False)
 
     def get_field_tasks(self):
-
-        taskdict = dict()
-        for field in self._meta.fields:
-            taskname = 'task_update_' + field.name
-            priorityname = taskname + '_priority'
-
-            if hasattr(self, taskname):
-                if hasattr(self, priorityname):
-                    priority = getattr(self, priorityname)
-                else:
-                    # FIXME: merge with constants in Transaction
-                    priority = 50
-            else:
-                priority = 0
-
-            if priority not in taskdict:
-                taskdict[priority] = set()
-
-            taskdict[priority].add(field.name)
-
-        tasklist = list()
-        for priority in reversed(sorted(taskdict.keys())):
-            for field in taskdict[priority]:
-                tasklist.append((priority, field))
-        return tasklist
+        """Returns list of (priority, field name) ordered by descending priority, see felis.registry"""
+        from felis.registry import get_registry
+        return get_registry(type(self)).field_tasks
 
     def save(self, *args, **kwargs):
         if kwargs.get('raw', False):
@@ -361,12 +505,57 @@ class Model(PolymorphicModel):
             kwargs['raw'] = True
         super(Model, self).save_base(*args, **kwargs)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Model, cls).from_db(db, field_names, values)
+        if len(values) == len(cls._meta.concrete_fields):
+            # values are ordered as concrete_fields if none of fields is deferred
+            instance._loaded_values = tuple(values)
+        return instance
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(Model, self).refresh_from_db(using=using, fields=fields)
+        # refreshed values are the stored ones now, changes are found against them on next save
+        if fields is not None:
+            self.take_snapshot(fields)
+        elif self.get_deferred_fields():
+            # snapshot would be incomplete, original row is fetched on save instead
+            self._loaded_values = None
+        else:
+            self.take_snapshot()
+
+    def take_snapshot(self, update_fields=None):
+        """
+        Remembers values of fields as they are stored in database, so changed fields may be found without fetching
+        the original row. Called after instance is saved.
+        """
+        if update_fields is None:
+            self._loaded_values = tuple(getattr(self, field.attname) for field in self._meta.concrete_fields)
+        elif getattr(self, '_loaded_values', None) is not None:
+            update_fields = set(update_fields)
+            self._loaded_values = tuple(
+                getattr(self, field.attname)
+                if field.name in update_fields or field.attname in update_fields
+                else value
+                for field, value
+                in zip(self._meta.concrete_fields, self._loaded_values)
+            )
+
+    def loaded_as_dict(self):
+        """
+        Returns values of fields as they were when instance was loaded or last saved in format of `as_dict',
+        or None if they are unknown
+        """
+        loaded_values = getattr(self, '_loaded_values', None)
+        if loaded_values is None:
+            return None
+        values = {field.attname: value for field, value in zip(self._meta.concrete_fields, loaded_values)}
+        return {field.name: values[field.attname] for field in self._meta.fields}
+
     def as_dict(self):
+        # foreign keys are represented by primary keys of related objects, using `attname' avoids fetching them
         return {
-            field.name:
-                getattr(self, field.name).pk
-                if isinstance(getattr(self, field.name), models.Model)
-                else getattr(self, field.name)
+            field.name: getattr(self, field.attname)
             for field
             in self._meta.fields
         }
@@ -413,22 +602,15 @@ class FSMMixin(models.Model):
         Checking whether status change is correct and calling corresponding callback
         Will raise FSMError otherwise which initiate transaction rollback
         """
-        allowed = False
-        for o, n in self.allowed_state_changes:
-            if (o is None) and (n == new):
-                allowed = True
-            elif (old == o) and (n is None):
-                allowed = True
-            elif (old == o) and (new == n):
-                allowed = True
-
-        if not allowed:
-            raise FSMError(
-                "State change for field `status' from `{0}' to `{1}' is not allowed".format(
-                    self.statusname(old), self.statusname(new)))
-        callback_name = 'task_update_status_'+self.statusname(old)+'_'+self.statusname(new)
-        if getattr(self, callback_name) and callable(getattr(self, callback_name)):
-            getattr(self, callback_name)(t)
+        from felis.registry import get_registry
+        callback_name = get_registry(type(self)).transition(old, new)
+        callback = getattr(self, callback_name, None)
+        if not callable(callback):
+            raise FSMError("State change callback `{0}' is not defined".format(callback_name))
+        callback(t)
+
+    # every state change runs its own callback so pending changes cannot be merged
+    task_update_status_coalesce = False
 
     def task_update_status(self, t):
         self.switch_status(t.old_instance.status, self.status, t)
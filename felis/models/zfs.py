@@ -1,11 +1,14 @@
 # -*- coding: utf-8 -*-
 
+from logging import getLogger
 from django.db import models
 from django.utils.translation import ugettext_lazy as _
 from .transaction import Model
 
 __all__ = ['Filesystem', 'Snapshot', 'Clone']
 
+logger = getLogger('felis.models')
+
 class Filesystem(Model):
     """
     Represents ZFS filesystem.
@@ -29,6 +32,11 @@ class Filesystem(Model):
     mountpoint = models.CharField(
         max_length=1024, blank=True, null=True, default=None, help_text=_('May not conside with ZFS path'))
 
+    zpath = models.CharField(
+        max_length=1024, db_index=True, editable=False, default='', help_text=_('ZFS path of filesystem'))
+    path = models.CharField(
+        max_length=1024, editable=False, default='', help_text=_('Unix path of mounted filesystem'))
+
     used = models.BigIntegerField(null=True, editable=False)
     avail = models.BigIntegerField(null=True, editable=False)
     refer = models.BigIntegerField(null=True, editable=False)
@@ -49,30 +57,101 @@ class Filesystem(Model):
         from felis.utils import size_prefixed
         return size_prefixed(self.quota)
 
-    @property
-    def path(self):
-        """Returns unix path of mounted filesystem"""
-        if self.mountpoint:
-            return self.mountpoint
-        elif self.parent:
-            return self.parent.path + '/' + self.name
+    @staticmethod
+    def build_paths(parent_paths, name, mountpoint):
+        """Returns tuple of ZFS path and unix path of filesystem given the same tuple of its parent or None"""
+        if parent_paths is None:
+            zpath, path = name, '/' + name
         else:
-            return '/' + self.name
+            zpath, path = parent_paths[0] + '/' + name, parent_paths[1] + '/' + name
+        if mountpoint:
+            path = mountpoint
+        return zpath, path
+
+    def refresh_paths(self):
+        """Recalculates materialized `zpath' and `path' fields from parent's ones"""
+        parent = self.parent
+        self.zpath, self.path = self.build_paths(
+            (parent.zpath, parent.path) if parent else None, self.name, self.mountpoint)
+
+    # fields materialized paths are calculated from
+    path_source_fields = ('name', 'parent_id', 'mountpoint')
+
+    def stored_path_fields(self):
+        """
+        Returns dict of `name', `parent_id', `mountpoint', `zpath' and `path' as they are stored in database
+        or None for a new filesystem
+        """
+        if self.pk is None:
+            return None
+        loaded = self.loaded_as_dict()
+        if loaded is not None:
+            return {
+                'name': loaded['name'], 'parent_id': loaded['parent'], 'mountpoint': loaded['mountpoint'],
+                'zpath': loaded['zpath'], 'path': loaded['path'],
+            }
+        return Filesystem.objects.filter(pk=self.pk).values(*self.path_source_fields, 'zpath', 'path').first()
 
     @property
-    def zpath(self):
-        """Returns ZFS path of filesystem"""
-        if not self.parent:
-            return self.name
-        else:
-            return self.parent.zpath + '/' + self.name
+    def descendants(self):
+        """All filesystems below this one, selected with a prefix scan of `zpath' index"""
+        return Filesystem.objects.filter(zpath__startswith=self.zpath + '/')
+
+    def refresh_descendants_paths(self, old_zpath):
+        """Rewrites materialized paths of filesystems which were below `old_zpath'"""
+        from felis.utils import bulk_update
+        paths = {self.pk: (self.zpath, self.path)}
+        rows = dict()
+        # ordering by zpath guarantees parent is processed before its children
+        for pk, parent_id, name, mountpoint in Filesystem.objects.filter(
+                zpath__startswith=old_zpath + '/'
+        ).order_by('zpath').values_list('pk', 'parent_id', 'name', 'mountpoint'):
+            paths[pk] = self.build_paths(paths.get(parent_id), name, mountpoint)
+            rows[pk] = {'zpath': paths[pk][0], 'path': paths[pk][1]}
+        bulk_update(Filesystem, rows, ('zpath', 'path'))
+
+    def save(self, *args, **kwargs):
+        # paths are recalculated (reading parent) only when fields they depend on change, raw saves of rollbacks
+        # included, so saving other fields does not query parent
+        stored = self.stored_path_fields()
+        if stored is None or any(stored[field] != getattr(self, field) for field in self.path_source_fields):
+            self.refresh_paths()
+            if kwargs.get('update_fields', None) is not None:
+                kwargs['update_fields'] = list(set(kwargs['update_fields']) | {'zpath', 'path'})
+        super(Filesystem, self).save(*args, **kwargs)
+        if stored is not None and (stored['zpath'], stored['path']) != (self.zpath, self.path):
+            self.refresh_descendants_paths(stored['zpath'])
 
     def __str__(self):
         return 'filesystem #{0}: {1}'.format(self.pk, self.name)
 
+    # fields whose tasks do nothing but `zfs set <property>=<value> {zpath}', such tasks may be run for many
+    # filesystems at once, see felis.tasks.commit_zfs_set_batch. Subclasses overriding these tasks are not
+    # batched (see felis.registry.TaskRegistry.batchable_zfs_fields)
+    zfs_set_fields = ('quota', 'mountpoint')
+
+    def zfs_property(self, field):
+        """Returns `<property>=<value>' argument of `zfs set' applying current value of `field'"""
+        if field == 'quota':
+            return 'quota=' + self.quota_prefixed
+        elif field == 'mountpoint':
+            return 'mountpoint=' + (self.mountpoint or 'none')
+        raise ValueError("Field `{0}' is not a ZFS property".format(field))
+
     # tasks
+    def zpath_before(self, t):
+        """
+        Returns ZFS path filesystem had before transaction `t'. Materialized paths are not tasks' fields, so their
+        previous values are stored by history transaction created by the same save right before `t'
+        """
+        from .transaction import Transaction
+        value = Transaction.objects.filter(
+            instance_id=self.pk, pk__lt=t.pk, value__has_key='zpath'
+        ).order_by('-pk').values_list('value', flat=True).first()
+        return value['zpath'] if value is not None else t.old_instance.zpath
+
     def task_update_name(self, t):
-        t.exec('zfs rename ' + t.old_instance.zpath + ' {zpath}')
+        t.exec('zfs rename ' + self.zpath_before(t) + ' {zpath}')
     task_update_name_priority = 80
 
     def task_update_quota(self, t):
@@ -171,18 +250,70 @@ class Clone(Filesystem):
     def task_create(self, t):
         return t.exec('zfs clone {base.zpath} {zpath}')
 
+def parse_zfs_statistics(output):
+    """Parses output of `zfs list -Hp -o name,used,avail,refer' into dict of {zpath: (used, avail, refer)}"""
+    def to_int(value):
+        return int(value) if value.isdigit() else None
+
+    stats = dict()
+    for line in output.split(b'\n'):
+        if line:
+            try:
+                name, used, avail, refer = line.split(b'\t')
+            except ValueError:
+                logger.warning("Unexpected line in output of `zfs list': {0}".format(line))
+                continue
+            stats[name.decode('utf-8', 'replace')] = (to_int(used), to_int(avail), to_int(refer))
+    return stats
+
+
+ZFS_STATISTICS_FIELDS = ('used', 'avail', 'refer')
+
+
+def resolve_zpaths(stats, filesystems):
+    """
+    Matches `stats' returned by `parse_zfs_statistics' with `filesystems', an iterable of
+    (pk, zpath, content type id, used, avail, refer) of known filesystems. Returns dict of
+    {pk: (content type id, {field: old value}, {field: new value})} of filesystems whose statistics changed.
+    Datasets unknown to felis and filesystems missing in `stats' are skipped.
+    """
+    changes = dict()
+    for pk, zpath, content_type_id, *values in filesystems:
+        if zpath not in stats:
+            continue
+        old = dict(zip(ZFS_STATISTICS_FIELDS, values))
+        new = dict(zip(ZFS_STATISTICS_FIELDS, stats[zpath]))
+        changed = {field for field in ZFS_STATISTICS_FIELDS if old[field] != new[field]}
+        if changed:
+            changes[pk] = (content_type_id, {field: old[field] for field in changed}, new)
+    return changes
+
+
 def update_current_zfs_statistics():
-    from felis.utils import run_shell_command
+    from django.utils import timezone
+    from felis.utils import run_shell_command, bulk_update
     from felis.errors import ZfsStatUpdateFailed
-    errcode, stdout, stderr = run_shell_command('zfs list -Hp')
+    from .transaction import Transaction, StateCheckpoint
+    errcode, stdout, stderr = run_shell_command('zfs list -Hp -o name,used,avail,refer')
     if errcode != 0:
         raise ZfsStatUpdateFailed()
-    stats = list(map(
-        lambda x: (x[0].decode('utf-8'), int(x[1]), int(x[2]), int(x[3])),
-        [i.split(b'\t') for i in stdout.split(b'\n') if i]
-    ))
-    for fs in Filesystem.objects.all():
-        for s in stats:
-            if fs.zpath == s[0]:
-                fs.used, fs.avail, fs.refer = s[1:4]
-                fs.save()
+    stats = parse_zfs_statistics(stdout)
+
+    committed = timezone.now()
+    rows = dict()
+    history = list()
+    for pk, (content_type_id, old, new) in resolve_zpaths(stats, Filesystem.objects.values_list(
+            'pk', 'zpath', 'polymorphic_ctype_id', *ZFS_STATISTICS_FIELDS)).items():
+        rows[pk] = new
+        # keeping history of values for charts, as it was done by signals on save
+        history.append(Transaction(
+            instance_id=pk,
+            content_type_id=content_type_id,
+            change_type=Transaction.UPDATE,
+            value=old,
+            committed=committed,
+            priority=0
+        ))
+    bulk_update(Filesystem, rows, ZFS_STATISTICS_FIELDS)
+    Transaction.objects.bulk_create(history)
+    StateCheckpoint.take(dict.fromkeys(rows.keys()))
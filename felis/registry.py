@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of tasks of :model:`felis.Model`'s subclasses.
+
+Tasks are discovered by names once per class when application is ready, so saving an instance does not need to
+look up `task_update_<field>' methods and their `_priority' attributes by reflection. Registry is validated by
+Django's system checks (`manage.py check'), e.g. a task without priority is reported rather than crashing later.
+"""
+
+from django.apps import apps
+from django.core import checks
+from felis.errors import FSMError
+
+__all__ = ['TaskRegistry', 'get_registry', 'task_models', 'build_registries']
+
+# priorities of tasks without `_priority' attribute
+DEFAULT_CREATE_PRIORITY = 100
+DEFAULT_UPDATE_PRIORITY = 50
+DEFAULT_DELETE_PRIORITY = 90
+
+
+class TaskRegistry:
+    """Tasks, their priorities and FSM transition table of one model class"""
+
+    def __init__(self, model):
+        self.model = model
+        self.missing_priorities = list()
+
+        self.create_priority = self.priority_of('task_create', DEFAULT_CREATE_PRIORITY)
+        self.delete_priority = self.priority_of('task_delete', DEFAULT_DELETE_PRIORITY)
+
+        # {field name: priority} of fields having a callable `task_update_<field>'
+        self.update_priorities = dict()
+        # fields whose pending updates may be merged, see felis.tasks.coalesce_transactions
+        self.coalescible_fields = set()
+        for field in model._meta.fields:
+            taskname = 'task_update_' + field.name
+            if callable(getattr(model, taskname, None)):
+                self.update_priorities[field.name] = self.priority_of(taskname, DEFAULT_UPDATE_PRIORITY)
+                if getattr(model, taskname + '_coalesce', True):
+                    self.coalescible_fields.add(field.name)
+
+        # list of (priority, field name) of all fields ordered by descending priority, fields without tasks have
+        # zero priority
+        self.field_tasks = sorted(
+            ((self.update_priorities.get(field.name, 0), field.name) for field in model._meta.fields),
+            key=lambda i: i[0],
+            reverse=True
+        )
+
+        self.transitions = self.build_transitions()
+
+        # fields whose tasks may be batched by felis.tasks.commit_zfs_set_batch, see `batchable_zfs_fields'
+        self.zfs_set_fields = self.batchable_zfs_fields()
+
+        # {task name: seconds} of tasks having `<task name>_timeout' attribute
+        self.timeouts = {
+            name[:-len('_timeout')]: getattr(model, name)
+            for name in dir(model)
+            if name.startswith('task_') and name.endswith('_timeout') and getattr(model, name, None) is not None
+        }
+
+    def batchable_zfs_fields(self):
+        """
+        Returns set of fields listed in `zfs_set_fields' whose tasks are still the ones of the class declaring
+        that list. A subclass overriding such task does more than `zfs set', so its transactions are not batched.
+        """
+        owner = next((klass for klass in self.model.__mro__ if 'zfs_set_fields' in vars(klass)), None)
+        if owner is None:
+            return set()
+        return {
+            field for field in owner.zfs_set_fields
+            if field in self.update_priorities
+            and getattr(self.model, 'task_update_' + field) is vars(owner).get('task_update_' + field)
+        }
+
+    def priority_of(self, taskname, default):
+        if not callable(getattr(self.model, taskname, None)):
+            return default
+        priority = getattr(self.model, taskname + '_priority', None)
+        if priority is None:
+            self.missing_priorities.append(taskname)
+            return default
+        return priority
+
+    def build_transitions(self):
+        """
+        Returns dict of {(old state, new state): callback name} of allowed state changes, where None in
+        `allowed_state_changes' means any state
+        """
+        allowed = getattr(self.model, 'allowed_state_changes', None)
+        if allowed is None or not hasattr(self.model, 'states'):
+            return dict()
+        states = {k for k, _v in self.model.states} | {s for change in allowed for s in change if s is not None}
+        transitions = dict()
+        for old, new in allowed:
+            for o in (states if old is None else (old, )):
+                for n in (states if new is None else (new, )):
+                    transitions[(o, n)] = 'task_update_status_{0}_{1}'.format(
+                        self.model.statusname(self.model, o), self.model.statusname(self.model, n))
+        return transitions
+
+    def priority(self, change_type, field=None):
+        from felis.models import Transaction
+        if change_type == Transaction.CREATE:
+            return self.create_priority
+        elif change_type == Transaction.UPDATE:
+            return self.update_priorities.get(field, DEFAULT_UPDATE_PRIORITY)
+        elif change_type == Transaction.DELETE:
+            return self.delete_priority
+
+    def transition(self, old, new):
+        """Returns name of callback of state change or raises FSMError if the change is not allowed"""
+        try:
+            return self.transitions[(old, new)]
+        except KeyError:
+            raise FSMError(
+                "State change for field `status' from `{0}' to `{1}' is not allowed".format(
+                    self.model.statusname(self.model, old), self.model.statusname(self.model, new)))
+
+
+_registries = dict()
+
+
+def get_registry(model):
+    """Returns registry of `model' class, building it if the class was not known when application became ready"""
+    try:
+        return _registries[model]
+    except KeyError:
+        _registries[model] = TaskRegistry(model)
+        return _registries[model]
+
+
+def task_models():
+    """Returns concrete subclasses of :model:`felis.Model`"""
+    from felis.models import Model
+    return [
+        model for model in apps.get_app_config('felis').get_models()
+        if issubclass(model, Model) and model is not Model
+    ]
+
+
+def build_registries():
+    for model in task_models():
+        get_registry(model)
+
+
+@checks.register()
+def check_task_registry(app_configs, **kwargs):
+    errors = list()
+    for model in task_models():
+        registry = get_registry(model)
+        for taskname in registry.missing_priorities:
+            errors.append(checks.Warning(
+                "Task `{0}' has no `{0}_priority' attribute, default priority is used".format(taskname),
+                obj=model,
+                id='felis.W001',
+            ))
+        # changes allowed from or to any state are not checked as most of them are not expected to happen
+        for old, new in getattr(model, 'allowed_state_changes', ()):
+            if old is None or new is None:
+                continue
+            callback = registry.transitions[(old, new)]
+            if not callable(getattr(model, callback, None)):
+                errors.append(checks.Warning(
+                    "State change from `{0}' to `{1}' is allowed but `{2}' is not defined".format(
+                        model.statusname(model, old), model.statusname(model, new), callback),
+                    obj=model,
+                    id='felis.W002',
+                ))
+        from felis.models.transaction import TRANSACTION_COMMIT_TIMEOUT
+        for taskname, timeout in sorted(registry.timeouts.items()):
+            if timeout >= TRANSACTION_COMMIT_TIMEOUT.total_seconds():
+                errors.append(checks.Warning(
+                    "Timeout of task `{0}' is not shorter than TRANSACTION_COMMIT_TIMEOUT, the transaction may be "
+                    "rolled back while its command is still running".format(taskname),
+                    obj=model,
+                    id='felis.W003',
+                ))
+    return errors
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import select
+import time
+import logging
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS, OperationalError, InterfaceError
+
+logger = logging.getLogger('felis.tasks')
+
+
+def get_channel():
+    return getattr(settings, 'FELIS_SCHEDULER_CHANNEL', 'felis_scheduler')
+
+
+def notify_scheduler(using=DEFAULT_DB_ALIAS):
+    """
+    Wakes up listening scheduler. PostgreSQL delivers notification only when current database transaction commits
+    and collapses identical notifications sent within one transaction, so it is safe to call this on every change.
+    Inside a changeset context notification is sent once, when the context exits.
+    """
+    from felis.changeset import defer_notification
+    if defer_notification():
+        return
+    with connections[using].cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [get_channel(), ''])
+
+
+class SchedulerListener:
+    """
+    Long-running scheduler process. LISTENs on FELIS_SCHEDULER_CHANNEL and runs a scheduler pass when notified.
+    Bursts of notifications are debounced: after the first one listener waits until the channel stays quiet for
+    FELIS_SCHEDULER_DEBOUNCE seconds (but not longer than FELIS_SCHEDULER_DEBOUNCE_MAX). If there were no
+    notifications for FELIS_SCHEDULER_IDLE_TIMEOUT seconds pass runs anyway to pick up stalled transactions.
+    """
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        self.debounce = getattr(settings, 'FELIS_SCHEDULER_DEBOUNCE', 0.05)
+        self.debounce_max = getattr(settings, 'FELIS_SCHEDULER_DEBOUNCE_MAX', 0.5)
+        self.idle_timeout = getattr(settings, 'FELIS_SCHEDULER_IDLE_TIMEOUT', 60)
+
+    @property
+    def connection(self):
+        return connections[self.using]
+
+    def listen(self):
+        self.connection.close()
+        self.connection.ensure_connection()
+        self.connection.set_autocommit(True)
+        with self.connection.cursor() as cursor:
+            cursor.execute('LISTEN {0}'.format(self.connection.ops.quote_name(get_channel())))
+        logger.info('Scheduler is listening on channel `{0}\''.format(get_channel()))
+        return self.connection.connection
+
+    def wait(self, pgconn, timeout):
+        """Returns True if notification arrived in `timeout' seconds"""
+        if pgconn.notifies:
+            return True
+        if select.select([pgconn], [], [], timeout) == ([], [], []):
+            return False
+        pgconn.poll()
+        return bool(pgconn.notifies)
+
+    def debounce_burst(self, pgconn):
+        deadline = time.monotonic() + self.debounce_max
+        while time.monotonic() < deadline:
+            del pgconn.notifies[:]
+            if not self.wait(pgconn, self.debounce):
+                break
+        del pgconn.notifies[:]
+
+    def run_pass(self):
+        from felis.tasks import run_scheduler_pass
+        try:
+            run_scheduler_pass()
+        except (OperationalError, InterfaceError, KeyboardInterrupt):
+            raise
+        except BaseException as e:
+            logger.exception('An Exception {0} occured trying to run task'.format(e))
+
+    def run_forever(self):
+        while True:
+            try:
+                pgconn = self.listen()
+                self.run_pass()
+                while True:
+                    if self.wait(pgconn, self.idle_timeout):
+                        self.debounce_burst(pgconn)
+                    self.run_pass()
+            except (OperationalError, InterfaceError) as e:
+                logger.exception('Scheduler lost database connection: {0}'.format(e))
+                time.sleep(1)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.10/ref/settings/
 """
 
 import os
+from datetime import timedelta
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -59,6 +60,7 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.contrib.admindocs.middleware.XViewMiddleware',
     'felis.middleware.AuthMiddleware',
+    'felis.changeset.ChangesetMiddleware',
     'felis.middleware.MessagingMiddleware',
 ]
 
@@ -284,6 +286,15 @@ CACHES = {
             "MAX_ENTRIES": 10000,
             "CLIENT_CLASS": "django_redis.client.DefaultClient",
         }
+    },
+    # rendered charts and times of the latest resource usage samples
+    "chart": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": "redis://192.168.172.8:6379/5",
+        "TIMEOUT": 3600,
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+        }
     }
 }
 
@@ -295,7 +306,8 @@ Q_CLUSTER = {
     'workers': 8,
     'daemonize_workers': False,             # Set daemon flag for workers, needs to be False for be able to child spawns
     'recycle': 500,                         # Number of tasks a worker will process before recycling
-    'timeout': 60,                          # Timeout for tasks, None = no timeout
+    'timeout': None,                        # Timeout for tasks, None = no timeout. Commands run by tasks are
+                                            # killed by executor after FELIS_EXEC_TIMEOUT or task's own timeout
     'compress': False,                      # Compress tasks in broker
     'save_limit': 1000,                     # Amount of successful tasks saved, 0 = unlimited, -1 = dont save
     'guard_cycle': 1,                       # Guard loop sleep in seconds, must be greater than 0 and less than 60.
@@ -320,3 +332,81 @@ FELIS_SCRIPTS_DIR = os.path.join(BASE_DIR, 'scripts')
 
 # Port offset for sshd(8) sessions. Actual port = FELIS_SSHD_PORT_OFFSET + <jail instance id>
 FELIS_SSHD_PORT_OFFSET = 50000
+
+# PostgreSQL LISTEN/NOTIFY channel used to wake up scheduler (see `manage.py felis_scheduler')
+FELIS_SCHEDULER_CHANNEL = 'felis_scheduler'
+
+# Scheduler waits for a burst of notifications to settle down for this many seconds before running a pass...
+FELIS_SCHEDULER_DEBOUNCE = 0.05
+
+# ...but not longer than this
+FELIS_SCHEDULER_DEBOUNCE_MAX = 0.5
+
+# Seconds without notifications after which scheduler runs a pass anyway
+FELIS_SCHEDULER_IDLE_TIMEOUT = 60
+
+# Number of `rctl -u' commands run simultaneously while collecting jails' resource usage
+FELIS_RCTL_COLLECT_WORKERS = 8
+
+# Class running privileged commands: felis.executor.SudoExecutor forks sudo(8) for every command,
+# felis.executor.HelperExecutor passes them to a helper started by `sudo manage.py felis_helper'
+FELIS_EXECUTOR = 'felis.executor.HelperExecutor'
+
+# Unix socket of privileged helper and its permissions
+FELIS_HELPER_SOCKET = '/var/run/felis/helper.sock'
+FELIS_HELPER_SOCKET_MODE = 0o660
+
+# Number of connections to privileged helper kept open by every worker process
+FELIS_HELPER_POOL_SIZE = 4
+
+# Default number of seconds a command run by task may take, see Transaction.timeout
+FELIS_EXEC_TIMEOUT = 60
+
+# Output of long-running commands is written to FELIS_WORK_DIR/transaction.log.d/<transaction id>.log,
+# log is rotated when it exceeds FELIS_TASK_LOG_MAX_BYTES keeping FELIS_TASK_LOG_BACKUP_COUNT previous files
+FELIS_TASK_LOG_MAX_BYTES = 10 * 1024 * 1024
+FELIS_TASK_LOG_BACKUP_COUNT = 5
+
+# A full state of instance is stored every FELIS_CHECKPOINT_INTERVAL transactions of it, see StateCheckpoint
+FELIS_CHECKPOINT_INTERVAL = 100
+
+# Finished transactions older than these periods are archived to FELIS_WORK_DIR/archive and deleted, see felis.archive.
+# `history' are changes that did not run any task (including statistics), `task' are committed changes that did,
+# `rolledback' are rolled back ones. None keeps transactions of that kind forever.
+FELIS_TRANSACTION_RETENTION = {
+    'history': timedelta(days=30),
+    'task': timedelta(days=365),
+    'rolledback': timedelta(days=90),
+}
+
+# Resource usage samples of jails older than this are archived too
+FELIS_RCTLSAMPLE_RETENTION = timedelta(days=30)
+
+# Number of rows archived and deleted at once
+FELIS_ARCHIVE_BATCH_SIZE = 1000
+
+# Maximum number of transactions of one changeset run simultaneously, None means no limit
+FELIS_CHANGESET_CONCURRENCY = 8
+
+# Maximum number of filesystems passed to one batched `zfs set', see felis.tasks.commit_zfs_set_batch
+FELIS_ZFS_BATCH_SIZE = 200
+
+# Series of charts are downsampled to FELIS_CHART_POINTS points by default, `?points=' may ask for more
+# but not more than FELIS_CHART_MAX_POINTS
+FELIS_CHART_POINTS = 500
+FELIS_CHART_MAX_POINTS = 2000
+
+# Number of the largest consumers of each resource kept in FleetSnapshot
+FELIS_FLEET_TOP_N = 10
+
+# Commands privileged helper is allowed to run
+FELIS_HELPER_COMMANDS = {
+    'zfs': '/sbin/zfs',
+    'jail': '/usr/sbin/jail',
+    'jexec': '/usr/sbin/jexec',
+    'rctl': '/usr/bin/rctl',
+    'ifconfig': '/sbin/ifconfig',
+    'ps': '/bin/ps',
+    'rebuild_world.sh': os.path.join(FELIS_SCRIPTS_DIR, 'rebuild_world.sh'),
+    'create_template.sh': os.path.join(FELIS_SCRIPTS_DIR, 'create_template.sh'),
+}
@@ -8,9 +8,11 @@ from django.dispatch import receiver
 from django.db.models import Q
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
-from django_q.tasks import async
-from felis.models import Model, Transaction, UserPreferences
+from felis.models import Transaction, TransactionDependency, StateCheckpoint, UserPreferences
 from felis.middleware import get_auth_user
+from felis.scheduler import notify_scheduler
+from felis.changeset import get_current_changeset
+from felis.registry import get_registry, task_models
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -23,6 +25,8 @@ def create_user_prefrences_user_logged_in_receiver(signal, sender, request, user
 
 @receiver(pre_save, sender=Transaction)
 def felis_changeset_pre_save_signal_receiver(instance, **kwargs):
+    if instance.pk is None and instance.changeset_id is None:
+        instance.changeset = get_current_changeset()
     instance.full_clean()
 
 
@@ -36,36 +40,90 @@ def felis_transaction_post_save_signal_receiver(instance, **kwargs):
             & Q(rolledback=None)
             & Q(priority__gt=instance.priority)
         )
-        if blocking_dependencies.first():
-            logger.debug(
-                "{0} dependencies: {1}".format(instance, blocking_dependencies.all()))
-        instance.depends.add(*[i for i in blocking_dependencies.all()])
+        edges = [
+            TransactionDependency(transaction_id=instance.pk, depends_on_id=pk)
+            for pk in blocking_dependencies.values_list('pk', flat=True)
+        ]
+        if edges:
+            logger.debug("{0} dependencies: {1}".format(instance, [edge.depends_on_id for edge in edges]))
+            TransactionDependency.objects.bulk_create(edges)
 
         if get_auth_user():
             instance.author = get_auth_user()
             instance.save()
-        async('felis.tasks.task_scheduler')
+        notify_scheduler()
+    elif instance.committed or instance.rolledback:
+        # transactions depending on this one may be ready now
+        notify_scheduler()
+
+
+def create_transactions(transactions, cache_value):
+    """
+    Creates transactions of one instance with a single INSERT, adds their dependencies with another one and caches
+    `cache_value' for all of them with one pipelined multi-set. Transactions must be ordered by descending priority.
+    Transaction's own pre_save and post_save signals are not sent, their work is done here.
+    """
+    if not transactions:
+        return transactions
+
+    author = get_auth_user()
+    changeset = get_current_changeset()
+    for transaction in transactions:
+        if author:
+            transaction.author = author
+        if changeset is not None:
+            transaction.changeset = changeset
+        # foreign keys are set by signal receivers from existing objects so there is no need to validate them
+        transaction.full_clean(exclude=('instance', 'content_type', 'author', 'changeset'))
+
+    # uncommited transactions with higher priority will be set as dependencies for new transactions
+    blocking = list(Transaction.objects.filter(
+        Q(instance=transactions[0].instance)
+        & Q(committed=None)
+        & Q(rolledback=None)
+        & Q(priority__gt=0)
+    ).values_list('pk', 'priority'))
+
+    transactions = Transaction.objects.bulk_create(transactions)
+
+    edges = list()
+    for transaction in transactions:
+        if transaction.committed is not None:
+            continue
+        depends = [pk for pk, priority in blocking if priority > transaction.priority]
+        if depends:
+            logger.debug("{0} dependencies: {1}".format(transaction, depends))
+        edges.extend(TransactionDependency(transaction_id=transaction.pk, depends_on_id=pk) for pk in depends)
+        blocking.append((transaction.pk, transaction.priority))
+    if edges:
+        TransactionDependency.objects.bulk_create(edges)
+
+    Transaction.cache.set_many({transaction.pk: cache_value for transaction in transactions})
+
+    if any(transaction.committed is None for transaction in transactions):
+        notify_scheduler()
+    return transactions
 
 
-@receiver(pre_save)
 def felis_abstract_model_pre_save_signal_receiver(instance, **kwargs):
     # print('pre_save', kwargs)
 
     if kwargs.get('raw', False):
         return
-    if kwargs['sender'] == Model or not issubclass(kwargs['sender'], Model):
-        return
 
     # pk will be not None if instance is updating but not creating
     if instance.pk is not None:
         logger.debug("Instance `{0}' of  model `{1}' is about to be updated".format(instance, kwargs['sender']))
-        original_instance = kwargs['sender'].objects.get(pk=instance.pk)
+        original_values = instance.loaded_as_dict()
+        if original_values is None:
+            # instance was not loaded from database or some of its fields were deferred
+            original_values = kwargs['sender'].objects.get(pk=instance.pk).as_dict()
 
         # getting set of changed fields
         fieldnames = set()
         for field in instance._meta.fields:
-            old_value = getattr(original_instance, field.name)
-            new_value = getattr(instance, field.name)
+            old_value = original_values[field.name]
+            new_value = getattr(instance, field.attname)
             if old_value != new_value:
                 logger.info("Changing property `{0}' of instance `{1}' class `{2}' from `{3}' to `{4}'".format(
                     field.name, instance, kwargs['sender'], old_value, new_value
@@ -73,28 +131,28 @@ def felis_abstract_model_pre_save_signal_receiver(instance, **kwargs):
                 fieldnames.add(field.name)
 
         # filter out fields that need to call the callback method as they are non-atomic and needs separate transaction
-        fields_with_tasks = set()
-        for field in fieldnames.copy():
-            taskname = 'task_update_' + field
-            if not hasattr(instance, taskname) or not callable(getattr(instance, taskname)):
-                # field have no callback method or expected attribute is not callable
-                pass
-            else:
-                fieldnames.remove(field)
-                fields_with_tasks.add(field)
+        fields_with_tasks = fieldnames.intersection(get_registry(kwargs['sender']).update_priorities)
+        fieldnames -= fields_with_tasks
+
+        if not fieldnames and not fields_with_tasks:
+            return
 
+        content_type = ContentType.objects.get_for_model(instance)
+        transactions = list()
         # creating one transaction for all updated fields that do not require running any callbacks
         if fieldnames:
             logger.debug(
                 "Creating transaction for updating field(s) {fields} of instance `{instance}', model `{model}' "
                 "that do _not_ require any task run".format(fields=fieldnames, instance=instance, model=kwargs['sender']))
-            Transaction.cache.set(Transaction.objects.create(
+            transactions.append(Transaction(
                 instance=instance,
-                content_type=ContentType.objects.get_for_model(instance),
+                content_type=content_type,
                 change_type=Transaction.UPDATE,
-                value={k: v for k, v in original_instance.as_dict().items() if k in fieldnames},
-                committed=timezone.now()
-            ).pk, {'old': original_instance.as_dict(), 'new': instance.as_dict(), 'cached': True})
+                value={k: v for k, v in original_values.items() if k in fieldnames},
+                committed=timezone.now(),
+                # no task is run, so it is history (see felis.archive.expired_transactions)
+                priority=0
+            ))
         # creating transactions in order of task's priority to make right dependencies of tasks
         for priority, fieldname in [i for i in instance.get_field_tasks() if i[0] > 0]:
             if fieldname in fields_with_tasks:
@@ -102,65 +160,74 @@ def felis_abstract_model_pre_save_signal_receiver(instance, **kwargs):
                     "Creating transaction for updating field `{field}' "
                     "of instance `{instance}', model `{model}' that require a task run".format(
                         field=fieldname, instance=instance, model=kwargs['sender']))
-                Transaction.cache.set(Transaction.objects.create(
+                transactions.append(Transaction(
                     instance=instance,
-                    content_type=ContentType.objects.get_for_model(instance),
+                    content_type=content_type,
                     change_type=Transaction.UPDATE,
-                    value={fieldname: getattr(original_instance, fieldname)},
+                    value={fieldname: original_values[fieldname]},
                     priority=priority
-                ).pk, {'old': original_instance.as_dict(), 'new': instance.as_dict(), 'cached': True})
+                ))
+        create_transactions(transactions, {'old': original_values, 'new': instance.as_dict(), 'cached': True})
     else:
         logger.debug("Instance `{0}' of  model `{1}' is about to be created".format(instance, kwargs['sender']))
 
 
-@receiver(post_save)
 def felis_abstract_model_post_save_signal_receiver(instance, **kwargs):
+    # raw saves are written to database too
+    instance.take_snapshot(kwargs.get('update_fields'))
     if kwargs.get('raw', False):
         return
-    if kwargs['sender'] == Model or not issubclass(kwargs['sender'], Model):
-        return
 
     if kwargs['created']:
         logger.info("Instance `{0}' of  model `{1}' have been created".format(instance, kwargs['sender']))
         logger.debug(
             "Creating transaction for creation instance `{0}' of model `{1}'".format(instance, kwargs['sender']))
-        Transaction.cache.set(Transaction.objects.create(
+        state = instance.as_dict()
+        transaction, = create_transactions([Transaction(
             instance=instance,
             content_type=ContentType.objects.get_for_model(instance),
             change_type=Transaction.CREATE,
             value=None,
-        ).pk, {'old': None, 'new': instance.as_dict(), 'cached': True})
+        )], {'old': None, 'new': state, 'cached': True})
+        # initial checkpoint, so states of a new instance are never rebuilt from an unbounded chain of transactions
+        StateCheckpoint.objects.create(instance=instance, transaction=transaction, state=state)
     else:
         logger.info("Instance `{0}' of  model `{1}' have been updated".format(instance, kwargs['sender']))
     # starting task scheduler
     # async('felis.tasks.task_scheduler')
 
 
-@receiver(pre_delete)
 def felis_abstract_model_pre_delete_signal_receiver(instance, **kwargs):
     # pre_delete signal does not accept 'raw' argument,
     # this hack is for delete without performing any actions
     if hasattr(instance, 'rollback_delete') and getattr(instance, 'rollback_delete'):
         return
-    if kwargs['sender'] == Model or not issubclass(kwargs['sender'], Model):
-        return
     # print('pre_delete', kwargs)
     logger.info("Instance `{0}' of  model `{1}' is about to be deleted".format(instance, kwargs['sender']))
     logger.debug(
         "Creating transaction for deleting instance `{0}' of model `{1}'".format(instance, kwargs['sender']))
-    Transaction.cache.set(Transaction.objects.create(
+    create_transactions([Transaction(
         instance=None,
         content_type=ContentType.objects.get_for_model(instance),
         change_type=Transaction.DELETE,
         value=instance.as_dict(),
-    ).pk, {'old': instance.as_dict(), 'new': None, 'cached': True})
+    )], {'old': instance.as_dict(), 'new': None, 'cached': True})
 
 
-@receiver(post_delete)
 def felis_abstract_model_post_delete_signal_receiver(instance, **kwargs):
     # print('post_delete', kwargs)
-    if kwargs['sender'] == Model or not issubclass(kwargs['sender'], Model):
-        return
     logger.info("Instance `{0}' of  model `{1}' have been deleted".format(instance, kwargs['sender']))
     # starting task scheduler
     # async('felis.tasks.task_scheduler')
+
+
+def connect_model_receivers():
+    """
+    Connects receivers above to signals of every concrete subclass of :model:`felis.Model`, so saving and deleting
+    instances of other models (sessions, log records, django_q tasks, transactions) does not call them at all
+    """
+    for model in task_models():
+        pre_save.connect(felis_abstract_model_pre_save_signal_receiver, sender=model)
+        post_save.connect(felis_abstract_model_post_save_signal_receiver, sender=model)
+        pre_delete.connect(felis_abstract_model_pre_delete_signal_receiver, sender=model)
+        post_delete.connect(felis_abstract_model_post_delete_signal_receiver, sender=model)
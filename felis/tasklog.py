@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+
+import os
+import os.path
+from django.conf import settings
+
+__all__ = ['TaskLog']
+
+
+class TaskLog:
+    """
+    Bounded on-disk log of output of commands run by a :model:`felis.Transaction`'s task.
+
+    Log is rotated when it grows over FELIS_TASK_LOG_MAX_BYTES, up to FELIS_TASK_LOG_BACKUP_COUNT previous
+    files are kept, so a task never holds more than one chunk of output in memory and never fills up the disk.
+    """
+
+    def __init__(self, transaction_id):
+        self.logdir = os.path.join(settings.FELIS_WORK_DIR, 'transaction.log.d')
+        self.path = os.path.join(self.logdir, str(transaction_id) + '.log')
+        self.max_bytes = getattr(settings, 'FELIS_TASK_LOG_MAX_BYTES', 10 * 1024 * 1024)
+        self.backup_count = getattr(settings, 'FELIS_TASK_LOG_BACKUP_COUNT', 5)
+        self.fh = None
+
+    def backup_path(self, n):
+        return '{0}.{1}'.format(self.path, n)
+
+    def open(self):
+        if not os.path.isdir(self.logdir):
+            os.makedirs(self.logdir, mode=0o770, exist_ok=True)
+        self.fh = open(self.path, 'ab')
+
+    def rotate(self):
+        self.fh.close()
+        for n in range(self.backup_count - 1, 0, -1):
+            if os.path.isfile(self.backup_path(n)):
+                os.replace(self.backup_path(n), self.backup_path(n + 1))
+        if self.backup_count > 0:
+            os.replace(self.path, self.backup_path(1))
+        else:
+            os.unlink(self.path)
+        self.fh = open(self.path, 'ab')
+
+    def write(self, data):
+        if self.fh is None:
+            self.open()
+        if self.fh.tell() and self.fh.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.fh.write(data)
+        self.fh.flush()
+
+    def close(self):
+        if self.fh is not None:
+            self.fh.close()
+            self.fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def tail(self, size=64 * 1024):
+        """Returns up to `size' last bytes of the log"""
+        chunks = list()
+        for path in [self.path] + [self.backup_path(n) for n in range(1, self.backup_count + 1)]:
+            if size <= 0 or not os.path.isfile(path):
+                break
+            with open(path, 'rb') as fh:
+                fh.seek(0, os.SEEK_END)
+                length = fh.tell()
+                fh.seek(max(0, length - size))
+                chunks.insert(0, fh.read())
+            size -= length
+        return b''.join(chunks)
+
+    def delete(self):
+        self.close()
+        for path in [self.path] + [self.backup_path(n) for n in range(1, self.backup_count + 1)]:
+            if os.path.isfile(path):
+                os.unlink(path)
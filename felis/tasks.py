@@ -1,68 +1,351 @@
 # -*- coding: utf-8 -*-
 
 from felis.models import *
-import time
-from datetime import timedelta
+from felis.models.transaction import TRANSACTION_COMMIT_TIMEOUT
+from django.conf import settings
 from django.utils import timezone
-from django.db.models import Q
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction as db_transaction
+from django.db.models import Q, Count, Exists, OuterRef
 import logging
 from django_q.tasks import async, fetch
+from felis.scheduler import notify_scheduler
+from felis.graph import DependencyGraph
+from felis.registry import get_registry
 
 logger = logging.getLogger(__name__)
 
-TRANSACTION_COMMIT_TIMEOUT = timedelta(hours=4)
+# first key of pg_try_advisory_xact_lock(int, int) taken on instance being changed, second one is instance's pk
+INSTANCE_LOCK_NAMESPACE = 0x66656c
+
+
+def pending_transactions():
+    """Transactions that have a task to run and have not been started yet"""
+    return Transaction.objects.filter(
+        Q(committed=None) &
+        Q(rolledback=None) &
+        Q(started=None) &
+        Q(priority__gt=0)
+    )
+
+
+def ready_transactions():
+    """
+    Pending transactions that may be started right now: all of their dependencies are committed
+    and no other transaction on the same instance is running. Evaluates as a single query. Dependants of
+    rolled back transactions are never ready, they are rolled back by `rollback_unrunnable_transactions'.
+    """
+    uncommitted_dependencies = TransactionDependency.objects.filter(
+        Q(transaction=OuterRef('pk'))
+        & Q(depends_on__committed=None)
+    )
+    running_siblings = Transaction.objects.filter(
+        Q(instance=OuterRef('instance'))
+        & Q(committed=None)
+        & Q(rolledback=None)
+        & ~Q(started=None)
+        & Q(priority__gt=0)
+    )
+    return pending_transactions().annotate(
+        blocked=Exists(uncommitted_dependencies),
+        busy=Exists(running_siblings),
+    ).filter(blocked=False, busy=False).order_by('-priority', 'pk')
+
+
+def stalled_transactions():
+    """Started transactions that did not finish in TRANSACTION_COMMIT_TIMEOUT"""
+    return Transaction.objects.filter(
+        Q(committed=None) &
+        Q(rolledback=None) &
+        ~Q(started=None) &
+        Q(priority__gt=0) &
+        Q(started__lt=timezone.now() - TRANSACTION_COMMIT_TIMEOUT)
+    )
+
+
+def coalesce_transactions():
+    """
+    Merges pending UPDATE transactions of the same instance and field into the earliest one. Tasks read the current
+    value of a field from instance and the earliest transaction stores the value preceding all of them, so it alone
+    applies the final value (and reverts all of them on rollback). Others are marked committed and superseded by it,
+    their dependencies are moved to it. Number of queries depends on the number of merged groups only.
+    """
+    siblings = Transaction.objects.filter(
+        Q(instance=OuterRef('instance'))
+        & Q(change_type=Transaction.UPDATE)
+        & Q(priority=OuterRef('priority'))
+        & Q(committed=None)
+        & Q(rolledback=None)
+        & Q(started=None)
+        & ~Q(pk=OuterRef('pk'))
+    )
+    with db_transaction.atomic():
+        candidates = pending_transactions().filter(
+            change_type=Transaction.UPDATE
+        ).exclude(
+            instance=None
+        ).annotate(
+            has_siblings=Exists(siblings)
+        ).filter(has_siblings=True).order_by('pk').select_for_update(skip_locked=True)
+
+        groups = dict()
+        for transaction in candidates:
+            if transaction.coalescible:
+                groups.setdefault((transaction.instance_id, transaction.field), list()).append(transaction)
+        groups = [group for group in groups.values() if len(group) > 1]
+        if not groups:
+            return
+
+        now = timezone.now()
+        superseded = dict()
+        for keeper, *others in groups:
+            logger.debug('Coalescing {0} into {1}'.format(others, keeper))
+            Transaction.objects.filter(pk__in=[t.pk for t in others]).update(committed=now, superseded_by=keeper)
+            superseded.update({t.pk: keeper.pk for t in others})
+
+        # transactions that depended on superseded ones now depend on keepers and keepers depend on everything
+        # superseded ones depended on
+        keepers = set(superseded.values())
+        touched = keepers | superseded.keys()
+        existing = set()
+        edges = set()
+        for transaction_id, depends_on_id in TransactionDependency.objects.filter(
+                Q(transaction__in=touched) | Q(depends_on__in=touched)
+        ).values_list('transaction_id', 'depends_on_id'):
+            if transaction_id not in superseded and depends_on_id not in superseded:
+                existing.add((transaction_id, depends_on_id))
+                continue
+            edge = (superseded.get(transaction_id, transaction_id), superseded.get(depends_on_id, depends_on_id))
+            if edge[0] != edge[1]:
+                edges.add(edge)
+        edges -= existing
+        if edges:
+            TransactionDependency.objects.bulk_create([
+                TransactionDependency(transaction_id=transaction_id, depends_on_id=depends_on_id)
+                for transaction_id, depends_on_id in edges
+            ])
+
+        # keeper applies the value cached for the latest superseded transaction
+        cached = Transaction.cache.get_many(list(superseded.keys()) + list(keepers))
+        values = {
+            keeper.pk: {**cached.get(keeper.pk, dict()), 'new': cached[others[-1].pk]['new']}
+            for keeper, *others in groups
+            if 'new' in cached.get(others[-1].pk, dict())
+        }
+        if values:
+            Transaction.cache.set_many(values)
+
+
+def lock_instances(instance_ids):
+    """
+    Takes transaction-level advisory locks on instances and returns set of ids of instances locked successfully.
+    Instances locked by another scheduler are skipped rather than waited for.
+    """
+    if not instance_ids:
+        return set()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT i FROM unnest(%s::integer[]) AS i WHERE pg_try_advisory_xact_lock(%s, i)',
+            [list(instance_ids), INSTANCE_LOCK_NAMESPACE]
+        )
+        return {row[0] for row in cursor.fetchall()}
+
+
+def running_by_changeset(changeset_ids):
+    """Returns dict of {changeset id: number of its running transactions}"""
+    if not changeset_ids:
+        return dict()
+    return dict(Transaction.objects.filter(
+        Q(changeset_id__in=changeset_ids)
+        & Q(committed=None)
+        & Q(rolledback=None)
+        & ~Q(started=None)
+        & Q(priority__gt=0)
+    ).order_by().values_list('changeset_id').annotate(count=Count('pk')))
+
+
+def claim_transactions(graph=None):
+    """
+    Marks ready transactions as started and returns them. Ready rows are locked with FOR UPDATE SKIP LOCKED
+    and their instances with advisory locks, so several schedulers may run simultaneously and each transaction
+    (and each instance) is claimed by one of them only. Among transactions of equal priority the ones with
+    longer chains of dependants in dependency `graph' are preferred, so the critical path is started first.
+    """
+    with db_transaction.atomic():
+        candidates = list(ready_transactions().select_for_update(skip_locked=True))
+        if graph is not None:
+            lengths = graph.chain_lengths()
+            candidates.sort(key=lambda t: (-t.priority, -lengths.get(t.pk, 0), t.pk))
+        locked_instances = lock_instances({t.instance_id for t in candidates if t.instance_id is not None})
+        # candidates were selected before advisory locks had been taken, so another scheduler may have started
+        # a transaction on the same instance in the meantime
+        busy_instances = set(Transaction.objects.filter(
+            Q(instance_id__in=locked_instances)
+            & Q(committed=None)
+            & Q(rolledback=None)
+            & ~Q(started=None)
+            & Q(priority__gt=0)
+        ).values_list('instance_id', flat=True))
+        running = running_by_changeset({t.changeset_id for t in candidates if t.changeset_id is not None})
+        concurrency = getattr(settings, 'FELIS_CHANGESET_CONCURRENCY', None)
+
+        claimed = list()
+        claimed_instances = set()
+        for transaction in candidates:
+            if concurrency and transaction.changeset_id is not None \
+                    and running.get(transaction.changeset_id, 0) >= concurrency:
+                logger.debug('Delaying {0} as {1} transactions of its changeset are running'.format(
+                    transaction, concurrency))
+                continue
+            # several transactions of one instance may be ready simultaneously if they have equal priorities,
+            # only the first one is started, others are delayed to next iteration
+            if transaction.instance_id is not None:
+                if transaction.instance_id not in locked_instances \
+                        or transaction.instance_id in busy_instances \
+                        or transaction.instance_id in claimed_instances:
+                    logger.debug('Delaying {0} as there is another transaction on instance #{1} already running'.format(
+                        transaction, transaction.instance_id))
+                    continue
+                claimed_instances.add(transaction.instance_id)
+            if transaction.changeset_id is not None:
+                running[transaction.changeset_id] = running.get(transaction.changeset_id, 0) + 1
+            claimed.append(transaction)
+
+        if claimed:
+            started = timezone.now()
+            Transaction.objects.filter(pk__in=[t.pk for t in claimed]).update(started=started)
+            for transaction in claimed:
+                transaction.started = started
+    return claimed
+
+
+def dispatch(transaction):
+    try:
+        task = fetch(async(transaction.commit))
+    except BaseException as e:
+        logger.exception('Cannot dispatch {0}: {1}'.format(transaction, e))
+        # releasing transaction to be claimed again
+        Transaction.objects.filter(pk=transaction.pk).update(started=None)
+        return
+    if task is not None:
+        Transaction.objects.filter(pk=transaction.pk).update(task=task)
+
+
+def zfs_set_field(transaction):
+    """Returns name of the field if transaction's task only runs `zfs set', None otherwise"""
+    if transaction.change_type != Transaction.UPDATE or not transaction.field or transaction.content_type_id is None:
+        return None
+    model = ContentType.objects.get_for_id(transaction.content_type_id).model_class()
+    if transaction.field in get_registry(model).zfs_set_fields:
+        return transaction.field
+
+
+def commit_zfs_set_batch(transaction_ids):
+    """
+    Commits transactions whose tasks only run `zfs set' with as few zfs(8) invocations as possible:
+    filesystems getting the same property value are passed to one `zfs set <property>=<value> <fs> <fs> ...'.
+    If a batch fails, its transactions are committed one by one, so the error is attributed (and the rollback is
+    done) to the transactions that actually failed.
+    """
+    from felis.executor import get_executor
+    transactions = list(Transaction.objects.filter(pk__in=transaction_ids).order_by('pk'))
+    instances = {i.pk: i for i in Model.objects.filter(pk__in=[t.instance_id for t in transactions])}
+    groups = dict()
+    for transaction in transactions:
+        if transaction.instance_id not in instances:
+            # instance was deleted after the transaction had been claimed, there is nothing to apply or revert
+            logger.warning('Dropping {0} as its instance does not exist anymore'.format(transaction))
+            Transaction.objects.filter(pk=transaction.pk).update(rolledback=timezone.now())
+            continue
+        transaction.instance = instances[transaction.instance_id]
+        assignment = transaction.instance.zfs_property(transaction.field)
+        groups.setdefault(assignment, list()).append(transaction)
+
+    batch_size = getattr(settings, 'FELIS_ZFS_BATCH_SIZE', 200)
+    for assignment, group in groups.items():
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            argv = ['zfs', 'set', assignment] + [t.instance.zpath for t in batch]
+            logger.info('Running command {0}'.format(' '.join(argv)))
+            try:
+                returncode, _stdout, stderr = get_executor().run(argv, settings.FELIS_EXEC_TIMEOUT)
+            except BaseException as e:
+                returncode, stderr = None, e
+            if returncode == 0:
+                for transaction in batch:
+                    transaction.commit(applied=True)
+                continue
+            logger.warning("Batched `zfs set {0}' failed with errorcode {1}: {2}, committing {3} one by one".format(
+                assignment, returncode, stderr, batch))
+            for transaction in batch:
+                transaction.commit()
+    notify_scheduler()
+
+
+def dispatch_zfs_set_batch(transactions):
+    try:
+        async(commit_zfs_set_batch, [t.pk for t in transactions])
+    except BaseException as e:
+        logger.exception('Cannot dispatch {0}: {1}'.format(transactions, e))
+        # releasing transactions to be claimed again
+        Transaction.objects.filter(pk__in=[t.pk for t in transactions]).update(started=None)
+
+
+def rollback_unrunnable_transactions(graph):
+    """
+    Rolls back pending transactions that can never be committed: all transitive dependants of rolled back
+    transactions and transactions on dependency cycles. Later transactions are rolled back first, so the values
+    of instances are restored to the ones preceding the earliest of them.
+    """
+    doomed = graph.doomed()
+    cycles = graph.cycles()
+    if cycles:
+        logger.warning('Transactions {0} depend on each other and will be rolled back'.format(sorted(cycles)))
+    if not doomed and not cycles:
+        return
+    with db_transaction.atomic():
+        for transaction in pending_transactions().filter(
+                pk__in=doomed | cycles
+        ).order_by('-pk').select_for_update(skip_locked=True):
+            logger.debug('Rolling back {0} as its dependency have been rolled back'.format(transaction))
+            transaction.rollback()
+
+
+def run_scheduler_pass():
+    """
+    Starts every runnable transaction. Number of queries issued does not depend on the number of pending
+    transactions, only on the number of transactions actually started, coalesced or rolled back.
+    """
+    coalesce_transactions()
+    graph = DependencyGraph.load()
+    # dependants of failed transactions are rolled back before anything is claimed
+    rollback_unrunnable_transactions(graph)
+
+    # transactions only running `zfs set' for the same property are committed by one task
+    batches = dict()
+    for transaction in claim_transactions(graph):
+        field = zfs_set_field(transaction)
+        if field is None:
+            dispatch(transaction)
+        else:
+            batches.setdefault(field, list()).append(transaction)
+    for batch in batches.values():
+        if len(batch) > 1:
+            dispatch_zfs_set_batch(batch)
+        else:
+            dispatch(batch[0])
+
+    with db_transaction.atomic():
+        for transaction in stalled_transactions().select_for_update(skip_locked=True):
+            # command may still be running, it is killed before its changes are reverted
+            transaction.cancel()
+            transaction.rollback()
+
 
 def task_scheduler():
     logger.debug('Checking for tasks to run...')
-    time.sleep(2)  # to ensure most changes have been written
     try:
-        # filtering out transactions which instance have been deleted to avoid circular-dependencies
-        #for transaction in Transaction.objects.filter(~Q(change_type=Transaction.DELETE) & Q(instance__isnull=True)):
-        #    transaction.delete()
-
-        # selecting all transactions need to run
-        for transaction in Transaction.objects.filter(
-            Q(committed=None) &
-            Q(rolledback=None) &
-            Q(started=None) &
-            Q(priority__gt=0)
-        ).order_by('-priority').all():
-            # filtering out transactions with unfinished dependencies
-            if not transaction.depends.filter(
-                Q(committed=None)
-                & Q(rolledback=None)
-                & Q(priority__gt=transaction.priority)
-            ).first():
-                # delaying task to next iteration if there is running tasks with same instance
-
-                if Transaction.objects.filter(
-                                        Q(committed=None)
-                                        & Q(rolledback=None)
-                                        & ~Q(started=None)
-                                        & Q(priority__gt=0)
-                                        & Q(instance=transaction.instance)):
-                    logger.debug('Delaying {0} as there is another transaction on {1} already running'.format(
-                        transaction, transaction.instance))
-                    continue
-                transaction.started = timezone.now()
-                transaction.task = fetch(async(transaction.commit))
-                transaction.save(force_update=True)
-            elif transaction.depends.filter(~Q(rolledback=None) & Q(priority__gt=transaction.priority)).first():
-                    logger.debug('Rolling back {0} as its dependency {1} have been rolled back'.format(
-                        transaction,
-                        transaction.depends.filter(~Q(rolledback=None) & Q(priority__gt=transaction.priority)).first())
-                    )
-                    transaction.rollback()
-            else:
-                logger.debug('Waiting for {0} to commit'.format(
-                    transaction.depends.filter(Q(committed=None) & Q(priority__gt=transaction.priority)).all()))
-        for transaction in Transaction.objects.filter(
-            Q(committed=None) &
-            Q(rolledback=None) &
-            ~Q(started=None) &
-            Q(started__lt=timezone.now() - TRANSACTION_COMMIT_TIMEOUT)
-        ):
-            transaction.rollback()
+        run_scheduler_pass()
     except BaseException as e:
         logger.exception('An Exception {0} occured trying to run task'.format(e))
     logger.debug('No tasks left to run.')
@@ -3,7 +3,7 @@
 import subprocess
 import re
 from time import sleep
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase
 from django.db.models import Q
 from django.contrib.contenttypes.models import ContentType
 from django.forms.models import model_to_dict
@@ -28,6 +28,10 @@ class FelisModelTests(TestCase):
         cs = f.transactions.first()
         self.assertIsNotNone(cs)
         self.assertEqual(cs.change_type, Transaction.CREATE)
+        # initial checkpoint is taken at creation
+        checkpoint = f.checkpoints.get()
+        self.assertEqual(checkpoint.transaction_id, cs.pk)
+        self.assertEqual(checkpoint.state['name'], 'testfilesystem0')
 
     def test_field_updating(self):
         # from fixtures
@@ -41,6 +45,55 @@ class FelisModelTests(TestCase):
         # old value for quota was None and it must be in serialized copy
         self.assertIsNone(cs.value['quota'])
 
+    def test_field_updating_does_not_refetch_instance(self):
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        f = Filesystem.objects.get(pk=2)
+        f.quota = 5 * 1024 * 1024 * 1024
+        with CaptureQueriesContext(connection) as ctx:
+            f.save()
+        self.assertFalse([
+            q for q in ctx.captured_queries
+            if q['sql'].startswith('SELECT') and 'felis_filesystem' in q['sql']
+        ])
+        self.assertIsNone(f.transactions.first().value['quota'])
+
+    def test_refresh_from_db_updates_snapshot(self):
+        stale = Filesystem.objects.get(pk=2)
+        fresh = Filesystem.objects.get(pk=2)
+        fresh.description = 'changed meanwhile'
+        fresh.save()
+        stale.refresh_from_db()
+        count = Transaction.objects.count()
+        stale.save()
+        # nothing changed since refresh, so no transaction is created
+        self.assertEqual(Transaction.objects.count(), count)
+
+    def test_materialized_paths(self):
+        child = Filesystem.objects.create(name='child', parent=self.test_filesystem1)
+        self.assertEqual(child.zpath, 'zroot/testfilesystem1/child')
+        f = Filesystem.objects.get(pk=self.test_filesystem1.pk)
+        f.name = 'renamed'
+        f.save()
+        child.refresh_from_db()
+        self.assertEqual(child.zpath, 'zroot/renamed/child')
+        self.assertEqual(child.path, '/zroot/renamed/child')
+        self.assertEqual([i.pk for i in f.descendants], [child.pk])
+
+    def test_rename_rollback_restores_paths(self):
+        child = Filesystem.objects.create(name='child', parent=self.test_filesystem1)
+        f = Filesystem.objects.get(pk=self.test_filesystem1.pk)
+        f.name = 'renamed'
+        f.save()
+        rename = f.transactions.get(change_type=Transaction.UPDATE, priority=80)
+        Transaction.cache.clear()
+        self.assertEqual(f.zpath_before(rename), 'zroot/testfilesystem1')
+        rename.rollback()
+        f.refresh_from_db()
+        child.refresh_from_db()
+        self.assertEqual((f.name, f.zpath), ('testfilesystem1', 'zroot/testfilesystem1'))
+        self.assertEqual(child.zpath, 'zroot/testfilesystem1/child')
+
     def test_instance_deleting(self):
         f = Filesystem.objects.get(name='testfilesystem1')
         serialized = model_to_dict(f, fields=[field.name for field in f._meta.fields])
@@ -59,6 +112,134 @@ class FelisModelTests(TestCase):
         self.assertEqual(css[0].value['quota'], 3 * 1024 * 1024 * 1024)
         self.assertEqual(f.transactions.first().depends.first(), None)
 
+    def test_directed_dependencies(self):
+        f = Filesystem.objects.get(pk=2)
+        f.name = 'renamed'
+        f.quota = 3 * 1024 * 1024 * 1024
+        f.save()
+        rename = f.transactions.get(change_type=Transaction.UPDATE, priority=80)
+        quota = f.transactions.get(change_type=Transaction.UPDATE, priority=20)
+        self.assertEqual(list(quota.depends.all()), [rename])
+        self.assertEqual(list(rename.depends.all()), [])
+        self.assertEqual(list(rename.dependants.all()), [quota])
+
+    def test_changeset(self):
+        from unittest import mock
+        from felis.changeset import changeset
+        with mock.patch('felis.scheduler.connections') as connections:
+            with changeset('provisioning') as scope:
+                f = Filesystem.objects.create(name='changeset', parent=self.test_filesystem1)
+                f.quota = 1024 * 1024 * 1024
+                f.save()
+                self.assertFalse(connections.__getitem__.called)
+            # scheduler is woken up once for the whole changeset
+            self.assertEqual(connections.__getitem__.call_count, 1)
+        self.assertEqual(set(scope.instance.transactions.all()), set(f.transactions.all()))
+        progress = scope.instance.progress
+        self.assertEqual(progress['total'], f.transactions.count())
+        self.assertFalse(progress['finished'])
+
+    def test_chart_series(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        from felis.views.charts import transaction_series
+        f = Filesystem.objects.get(pk=2)
+        content_type = ContentType.objects.get_for_model(f)
+        for used, avail in ((1, 10), (2, None), (3, 8)):
+            Transaction.objects.create(
+                instance=f, content_type=content_type, change_type=Transaction.UPDATE,
+                value={'used': used, 'avail': avail}, committed=timezone.now(), priority=0)
+        with self.assertNumQueries(1):
+            series = transaction_series(f, ['used', 'avail', 'refer'], timezone.now() - timedelta(hours=1))
+        self.assertEqual([value for created, value in series['used']], [1, 2, 3])
+        self.assertEqual([value for created, value in series['avail']], [10, 8])
+        self.assertEqual(series['refer'], [])
+
+    def test_coalescing(self):
+        from felis.tasks import coalesce_transactions
+        f = Filesystem.objects.get(pk=2)
+        for size in (3, 4, 5):
+            f.quota = size * 1024 * 1024 * 1024
+            f.save()
+        first, *others = f.transactions.filter(change_type=Transaction.UPDATE).order_by('pk')
+        coalesce_transactions()
+        first.refresh_from_db()
+        self.assertIsNone(first.committed)
+        self.assertIsNone(first.value['quota'])
+        self.assertEqual(
+            [t.pk for t in others],
+            [t.pk for t in first.supersedes.filter(committed__isnull=False).order_by('pk')]
+        )
+
+    def test_dependants_of_rolled_back_transaction_are_not_started(self):
+        from unittest import mock
+        from django.utils import timezone
+        from felis.tasks import run_scheduler_pass
+        f = Filesystem.objects.get(pk=2)
+        f.name = 'renamed'
+        f.quota = 3 * 1024 * 1024 * 1024
+        f.save()
+        rename = f.transactions.get(change_type=Transaction.UPDATE, priority=80)
+        quota = f.transactions.get(change_type=Transaction.UPDATE, priority=20)
+        Transaction.objects.filter(pk=rename.pk).update(rolledback=timezone.now())
+        with mock.patch('felis.tasks.async'), mock.patch('felis.tasks.fetch', return_value=None):
+            run_scheduler_pass()
+        quota.refresh_from_db()
+        self.assertIsNotNone(quota.rolledback)
+        self.assertIsNone(quota.started)
+
+    def test_zfs_set_batching(self):
+        from unittest import mock
+        from felis.tasks import commit_zfs_set_batch
+        filesystems = [
+            Filesystem.objects.create(name='batch{0}'.format(i), parent=self.test_filesystem1) for i in range(3)]
+        for f in filesystems:
+            f.quota = 1024 * 1024 * 1024
+            f.save()
+        transactions = Transaction.objects.filter(
+            instance__in=filesystems, change_type=Transaction.UPDATE, committed=None)
+        executor = mock.Mock()
+        executor.run.return_value = (0, b'', b'')
+        with mock.patch('felis.executor.get_executor', return_value=executor):
+            commit_zfs_set_batch([t.pk for t in transactions])
+        executor.run.assert_called_once()
+        argv = executor.run.call_args[0][0]
+        self.assertEqual(argv[:3], ['zfs', 'set', 'quota=' + filesystems[0].quota_prefixed])
+        self.assertEqual(argv[3:], [f.zpath for f in filesystems])
+        self.assertFalse(transactions.exists())
+
+    def test_zfs_set_batch_of_deleted_filesystem(self):
+        from unittest import mock
+        from felis.tasks import commit_zfs_set_batch
+        f = Filesystem.objects.create(name='deleted', parent=self.test_filesystem1)
+        f.quota = 1024 * 1024 * 1024
+        f.save()
+        quota = f.transactions.get(change_type=Transaction.UPDATE, priority=20)
+        f.delete()
+        executor = mock.Mock()
+        with mock.patch('felis.executor.get_executor', return_value=executor):
+            commit_zfs_set_batch([quota.pk])
+        executor.run.assert_not_called()
+        quota.refresh_from_db()
+        self.assertIsNotNone(quota.rolledback)
+
+    def test_history_with_cold_cache(self):
+        from django.test import override_settings
+        f = Filesystem.objects.get(pk=2)
+        quotas = [size * 1024 * 1024 * 1024 for size in range(1, 6)]
+        with override_settings(FELIS_CHECKPOINT_INTERVAL=2):
+            for quota in quotas:
+                f.quota = quota
+                f.save()
+            # checkpoints are not taken on save
+            self.assertFalse(f.checkpoints.exists())
+            StateCheckpoint.take()
+        self.assertTrue(f.checkpoints.exists())
+        transactions = f.transactions.filter(change_type=Transaction.UPDATE, committed=None).order_by('pk')
+        Transaction.cache.clear()
+        self.assertEqual([t.new_values_dict['quota'] for t in transactions], quotas)
+        self.assertEqual([t.old_values_dict['quota'] for t in transactions], [None] + quotas[:-1])
+
     def test_multiple_fields_updating(self):
         f = Filesystem.objects.get(name='multiple_updating_test')
         f.quota = 4 * 1024 * 1024 * 1024
@@ -70,6 +251,431 @@ class FelisModelTests(TestCase):
         self.assertIsNone(f.transactions.filter(change_type=Transaction.UPDATE, field='description').first())
         self.assertIsNotNone(f.transactions.filter(change_type=Transaction.UPDATE, field=None).first())
 
+class SchedulerBenchmarkTests(TestCase):
+    fixtures = ['felis.json']
+
+    def make_backlog(self, size):
+        """
+        Adds about `size' pending transactions on new filesystems: a creation and updates of two fields of each.
+        Updates are blocked by the creation of their filesystem and by the previous filesystem's quota update, so
+        both ready and blocked transactions grow with the backlog.
+        """
+        content_type = ContentType.objects.get_for_model(Filesystem)
+        parent = Filesystem.objects.get(pk=1)
+        previous = None
+        for i in range(size // 3):
+            f = Filesystem.objects.create(name='backlog{0}-{1}'.format(size, i), parent=parent)
+            for field, priority in (('mountpoint', 30), ('quota', 20)):
+                transaction = Transaction.objects.create(
+                    instance=f,
+                    content_type=content_type,
+                    change_type=Transaction.UPDATE,
+                    value={field: None},
+                    priority=priority
+                )
+            if previous is not None:
+                TransactionDependency.objects.create(transaction=transaction, depends_on=previous)
+            previous = transaction
+
+    def count_pass_queries(self):
+        from unittest import mock
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from felis.tasks import run_scheduler_pass
+        Transaction.objects.update(started=None)
+        with mock.patch('felis.tasks.async'), mock.patch('felis.tasks.fetch', return_value=None):
+            with CaptureQueriesContext(connection) as ctx:
+                run_scheduler_pass()
+        return len(ctx.captured_queries)
+
+    def test_pass_query_count_is_constant(self):
+        from felis.tasks import pending_transactions, ready_transactions
+        counts = list()
+        ready = list()
+        for size in (10, 100, 500):
+            self.make_backlog(size)
+            counts.append(self.count_pass_queries())
+            Transaction.objects.update(started=None)
+            ready.append(ready_transactions().count())
+            self.assertLess(ready[-1], pending_transactions().count())
+        self.assertEqual(ready, sorted(set(ready)), 'Ready transactions do not grow: {0}'.format(ready))
+        self.assertEqual(len(set(counts)), 1, 'Queries per scheduler pass: {0}'.format(counts))
+
+
+class SchedulerListenerTests(SimpleTestCase):
+
+    class Connection:
+        """Fake psycopg2 connection receiving `bursts' of notifications, one notification per poll()"""
+
+        def __init__(self, notifications):
+            self.pending = notifications
+            self.notifies = list()
+
+        def poll(self):
+            if self.pending:
+                self.pending -= 1
+                self.notifies.append('notify')
+
+    def run_listener(self, notifications, passes, **settings):
+        from unittest import mock
+        from django.test import override_settings
+        from felis.scheduler import SchedulerListener
+        pgconn = self.Connection(notifications)
+        left = list()
+
+        def run_pass():
+            # notifications not received yet when a pass is run
+            left.append(pgconn.pending)
+            if len(left) == passes:
+                raise KeyboardInterrupt
+
+        def select(rlist, wlist, xlist, timeout):
+            return (rlist, [], []) if pgconn.pending else ([], [], [])
+
+        with override_settings(**settings):
+            listener = SchedulerListener()
+        with mock.patch.object(listener, 'listen', return_value=pgconn), \
+                mock.patch.object(listener, 'run_pass', side_effect=run_pass), \
+                mock.patch('felis.scheduler.select.select', side_effect=select):
+            with self.assertRaises(KeyboardInterrupt):
+                listener.run_forever()
+        return left
+
+    def test_burst_is_collapsed_into_one_pass(self):
+        # initial pass, one pass for the whole burst of 20 notifications and an idle pass
+        self.assertEqual(self.run_listener(20, 3, FELIS_SCHEDULER_DEBOUNCE_MAX=60), [20, 0, 0])
+
+    def test_endless_burst_is_bounded(self):
+        # notifications keep arriving, pass is run after FELIS_SCHEDULER_DEBOUNCE_MAX anyway
+        left = self.run_listener(10 ** 9, 2, FELIS_SCHEDULER_DEBOUNCE_MAX=0.01)
+        self.assertGreater(left[1], 0)
+
+
+class IndexUsageTests(TestCase):
+    """Checks that hot queries are planned with dedicated indexes rather than by scanning the table"""
+    fixtures = ['felis.json']
+
+    def explain(self, queryset):
+        from django.db import connection
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('EXPLAIN ' + sql, params)
+            return '\n'.join(row[0] for row in cursor.fetchall())
+
+    def test_scheduler_queries(self):
+        from felis.tasks import pending_transactions, stalled_transactions
+        self.assertRegex(self.explain(pending_transactions()), 'felis_txn_(pending|unfinished)_idx')
+        self.assertRegex(self.explain(stalled_transactions()), 'felis_txn_(running|unfinished)_idx')
+
+    def test_chart_queries(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        self.assertIn('felis_txn_inst_created_idx', self.explain(Transaction.objects.filter(
+            instance_id=2, created__gt=timezone.now() - timedelta(hours=6))))
+        self.assertIn('felis_txn_value_gin', self.explain(Transaction.objects.filter(value__has_key='used')))
+
+    def test_home_page_queries(self):
+        from datetime import timedelta
+        from django.utils import timezone
+        self.assertIn('felis_txn_author_idx', self.explain(Transaction.objects.filter(
+            author_id=1, rolledback__gt=timezone.now() - timedelta(days=1))))
+
+
+class ArchiveTests(TestCase):
+    fixtures = ['felis.json']
+
+    def test_expired_history_is_archived(self):
+        import os
+        import gzip
+        import json
+        import tempfile
+        from datetime import timedelta
+        from django.test import override_settings
+        from django.utils import timezone
+        from felis.archive import archive_expired
+        f = Filesystem.objects.get(pk=2)
+        f.description = 'old'
+        f.save()
+        f.quota = 1024 * 1024 * 1024
+        f.save()
+        old = f.transactions.get(change_type=Transaction.UPDATE, priority=0)
+        self.assertEqual(set(old.value), {'description'})
+        Transaction.objects.filter(pk=old.pk).update(committed=timezone.now() - timedelta(days=60))
+        workdir = tempfile.mkdtemp()
+        with override_settings(FELIS_WORK_DIR=workdir, FELIS_TRANSACTION_RETENTION={'history': timedelta(days=30)}):
+            archive_expired()
+        self.assertFalse(Transaction.objects.filter(pk=old.pk).exists())
+        # pending transaction is kept
+        self.assertTrue(f.transactions.filter(committed=None).exists())
+        archives = os.listdir(os.path.join(workdir, 'archive'))
+        with gzip.open(os.path.join(workdir, 'archive', archives[0]), 'rt') as archive:
+            self.assertEqual([json.loads(line)['id'] for line in archive], [old.pk])
+
+    def test_checkpointed_transactions_are_kept(self):
+        import tempfile
+        from datetime import timedelta
+        from django.test import override_settings
+        from django.utils import timezone
+        from felis.archive import archive_expired
+        f = Filesystem.objects.get(pk=2)
+        f.description = 'old'
+        f.save()
+        old = f.transactions.get(change_type=Transaction.UPDATE, priority=0)
+        checkpoint = StateCheckpoint.objects.create(instance=f, transaction=old, state=f.as_dict())
+        Transaction.objects.filter(pk=old.pk).update(committed=timezone.now() - timedelta(days=60))
+        with override_settings(FELIS_WORK_DIR=tempfile.mkdtemp(),
+                               FELIS_TRANSACTION_RETENTION={'history': timedelta(days=30)}):
+            archive_expired()
+        self.assertTrue(Transaction.objects.filter(pk=old.pk).exists())
+        self.assertTrue(StateCheckpoint.objects.filter(pk=checkpoint.pk).exists())
+
+
+class ZfsStatisticsTests(SimpleTestCase):
+
+    output = (
+        b'zroot\t1073741824\t9663676416\t98304\n'
+        b'zroot/jails\t536870912\t9663676416\t536870912\n'
+        b'zroot/jails/web@skel\t0\t-\t4096\n'
+        b'zroot/unknown\t4096\t9663676416\t4096\n'
+        b'cannot open dataset: permission denied\n'
+        b'\n'
+    )
+
+    def test_parsing(self):
+        from felis.models.zfs import parse_zfs_statistics
+        stats = parse_zfs_statistics(self.output)
+        self.assertEqual(stats['zroot'], (1073741824, 9663676416, 98304))
+        # `-' is reported for properties not applicable to snapshots
+        self.assertEqual(stats['zroot/jails/web@skel'], (0, None, 4096))
+        # malformed line is skipped
+        self.assertEqual(len(stats), 4)
+
+    def test_resolving(self):
+        from felis.models.zfs import parse_zfs_statistics, resolve_zpaths
+        stats = parse_zfs_statistics(self.output)
+        changes = resolve_zpaths(stats, [
+            (1, 'zroot', 7, 1073741824, 9663676416, 98304),
+            (2, 'zroot/jails', 7, 1, 9663676416, 536870912),
+            # destroyed outside of felis
+            (3, 'zroot/gone', 7, 1, 2, 3),
+        ])
+        # unchanged filesystem, unknown datasets and missing filesystems are skipped
+        self.assertEqual(changes, {
+            2: (7, {'used': 1}, {'used': 536870912, 'avail': 9663676416, 'refer': 536870912}),
+        })
+
+
+class RctlCollectorTests(TestCase):
+
+    def test_failures_are_isolated(self):
+        from unittest import mock
+        from felis.models.rctl import collect_rctl_usage
+
+        def run_shell_command(command, **kwargs):
+            if command.endswith('broken'):
+                return 1, b'', b'rctl: failed to get limits'
+            return 0, b'cputime=10\nmemoryuse=4096\nunknown=1\n', b''
+
+        with mock.patch('felis.utils.run_shell_command', side_effect=run_shell_command):
+            usage, failures = collect_rctl_usage(['one', 'broken', 'two'])
+        self.assertEqual(usage, {
+            'one': {'cputime': 10, 'memoryuse': 4096},
+            'two': {'cputime': 10, 'memoryuse': 4096},
+        })
+        self.assertEqual(list(failures.keys()), ['broken'])
+
+
+class HelperExecutorTests(SimpleTestCase):
+
+    def setUp(self):
+        import os
+        import tempfile
+        import threading
+        from felis.executor import HelperServer, HelperExecutor
+        self.path = os.path.join(tempfile.mkdtemp(), 'helper.sock')
+        self.server = HelperServer(self.path, commands={'echo': '/bin/echo'})
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.executor = HelperExecutor(self.path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_whitelisted_command(self):
+        self.assertEqual(self.executor.run(['echo', 'felis']), (0, b'felis\n', b''))
+        # pooled connection is reused
+        self.assertEqual(self.executor.run(['echo', 'again']), (0, b'again\n', b''))
+
+    def test_not_whitelisted_command(self):
+        returncode, stdout, stderr = self.executor.run(['rm', '-rf', '/'])
+        self.assertEqual(returncode, 126)
+        self.assertEqual(stdout, b'')
+
+    def test_timeout_and_cancel(self):
+        from felis.errors import TaskTimeout, TaskCancelled
+        from felis.executor import LocalExecutor
+        with self.assertRaises(TaskTimeout):
+            LocalExecutor().run(['sleep', '30'], timeout=1)
+        with self.assertRaises(TaskCancelled):
+            LocalExecutor().run(['sleep', '30'], should_cancel=lambda: True)
+
+
+class TaskRegistryTests(SimpleTestCase):
+
+    def test_priorities(self):
+        from felis.registry import get_registry
+        registry = get_registry(Filesystem)
+        self.assertEqual(registry.priority(Transaction.UPDATE, 'quota'), 20)
+        self.assertEqual(registry.priority(Transaction.UPDATE, 'description'), 50)
+        self.assertEqual(registry.field_tasks[0], (80, 'name'))
+        self.assertEqual(get_registry(Jail).priority(Transaction.DELETE), 60)
+
+    def test_transitions(self):
+        from felis.errors import FSMError
+        from felis.registry import get_registry
+        registry = get_registry(Jail)
+        self.assertEqual(registry.transition(Jail.STOPPED, Jail.STARTING), 'task_update_status_stopped_starting')
+        with self.assertRaises(FSMError):
+            registry.transition(Jail.RUNNING, Jail.STARTING)
+
+    def test_missing_priority_is_reported(self):
+        from felis.registry import check_task_registry
+        warnings = [
+            w for w in check_task_registry(None) if w.id == 'felis.W001' and w.obj is Jail]
+        self.assertIn('task_update_console', warnings[0].msg)
+
+    def test_zfs_set_batching_respects_overridden_tasks(self):
+        from felis.registry import TaskRegistry, get_registry
+        self.assertEqual(get_registry(Jail).zfs_set_fields, {'quota', 'mountpoint'})
+
+        # plain classes are enough for registry, defining models here would register them in the application
+        class Base:
+            _meta = Filesystem._meta
+            zfs_set_fields = Filesystem.zfs_set_fields
+            task_update_quota = Filesystem.task_update_quota
+            task_update_mountpoint = Filesystem.task_update_mountpoint
+
+        class QuotaOverride(Base):
+            def task_update_quota(self, t):
+                t.exec('zfs set quota={quota_prefixed} {zpath}')
+                t.exec('zfs set refquota={quota_prefixed} {zpath}')
+
+        self.assertEqual(TaskRegistry(Base).zfs_set_fields, {'quota', 'mountpoint'})
+        self.assertEqual(TaskRegistry(QuotaOverride).zfs_set_fields, {'mountpoint'})
+
+    def test_task_timeouts_are_shorter_than_commit_timeout(self):
+        from felis.registry import get_registry, check_task_registry
+        self.assertEqual(get_registry(World).timeouts['task_update_status'], 4 * 3600)
+        self.assertFalse([w for w in check_task_registry(None) if w.id == 'felis.W003'])
+
+
+class SignalReceiversTests(SimpleTestCase):
+
+    def test_receivers_are_sender_scoped(self):
+        from django.db.models.signals import pre_save
+        from felis.signals import felis_abstract_model_pre_save_signal_receiver as receiver
+        self.assertIn(receiver, pre_save._live_receivers(Jail))
+        self.assertIn(receiver, pre_save._live_receivers(Filesystem))
+        self.assertNotIn(receiver, pre_save._live_receivers(Transaction))
+        self.assertNotIn(receiver, pre_save._live_receivers(UserPreferences))
+
+
+class DependencyGraphTests(SimpleTestCase):
+
+    def test_rollback_cascades_to_all_dependants(self):
+        from felis.graph import DependencyGraph
+        graph = DependencyGraph([(2, 1), (3, 2), (4, 1), (5, 3), (7, 6)], failed={1})
+        self.assertEqual(graph.doomed(), {2, 3, 4, 5})
+        self.assertEqual(graph.critical_path(), [1, 2, 3, 5])
+        self.assertEqual(graph.cycles(), set())
+
+    def test_cycles(self):
+        from felis.graph import DependencyGraph
+        graph = DependencyGraph([(1, 2), (2, 3), (3, 1), (4, 3), (3, 5)])
+        self.assertEqual(graph.topological_order(), [5])
+        # transaction 4 waits for a cycle but is not a part of it
+        self.assertEqual(graph.cycles(), {1, 2, 3})
+
+
+class FleetSnapshotTests(SimpleTestCase):
+
+    def test_aggregates(self):
+        from felis.models.rctl import fleet_snapshot
+        rows = {
+            1: {'rctl_pcpu': 90, 'rctl_memoryuse': 100},
+            2: {'rctl_pcpu': 5, 'rctl_memoryuse': 300},
+            3: {'rctl_pcpu': 40},
+        }
+        jails = {1: ('one', 10, 20), 2: ('two', 10, None), 3: ('three', 11, 20)}
+        snapshot = fleet_snapshot(rows, jails, {10: 'base', 11: 'web'}, {20: 'world'}, top=2)
+        self.assertEqual(snapshot['jails'], 3)
+        self.assertEqual(snapshot['host']['pcpu'], 135)
+        self.assertEqual(snapshot['top']['pcpu'], [[1, 'one', 90], [3, 'three', 40]])
+        self.assertEqual(snapshot['top']['memoryuse'], [[2, 'two', 300], [1, 'one', 100]])
+        self.assertEqual(
+            [(g['name'], g['jails'], g['totals']['pcpu']) for g in snapshot['skels']],
+            [('base', 2, 95), ('web', 1, 40)])
+        self.assertEqual(
+            [(g['name'], g['jails'], g['totals']['memoryuse']) for g in snapshot['worlds']],
+            [('world', 2, 100), (None, 1, 300)])
+
+
+class DownsampleTests(SimpleTestCase):
+
+    def series(self, length):
+        import math
+        from datetime import datetime, timedelta
+        start = datetime(2017, 1, 1)
+        # a sine with a single spike in the middle
+        return [
+            (start + timedelta(minutes=i), 1000 if i == length // 2 else math.sin(i / 50))
+            for i in range(length)
+        ]
+
+    def test_downsampling(self):
+        from felis.downsample import lttb, minmax
+        series = self.series(43200)
+        for method in (lttb, minmax):
+            sampled = method(series, 500)
+            self.assertLessEqual(len(sampled), 500)
+            self.assertEqual(sampled[0], series[0])
+            self.assertEqual(sampled[-1], series[-1])
+            self.assertEqual(sampled, sorted(sampled))
+            self.assertIn(series[21600], sampled)
+
+    def test_short_series_are_not_changed(self):
+        from felis.downsample import downsample
+        series = self.series(100)
+        self.assertEqual(downsample(series, 500), series)
+        self.assertEqual(downsample(series, 500, 'minmax'), series)
+
+    def test_tiny_threshold_never_returns_whole_series(self):
+        from felis.downsample import lttb, minmax
+        series = self.series(1000)
+        for method in (lttb, minmax):
+            for threshold in (1, 2, 3):
+                self.assertLessEqual(len(method(series, threshold)), max(threshold, 2))
+
+
+class TaskLogTests(SimpleTestCase):
+
+    def test_rotation(self):
+        import tempfile
+        from django.test import override_settings
+        from felis.tasklog import TaskLog
+        with override_settings(
+                FELIS_WORK_DIR=tempfile.mkdtemp(), FELIS_TASK_LOG_MAX_BYTES=100, FELIS_TASK_LOG_BACKUP_COUNT=2):
+            with TaskLog(1) as log:
+                for i in range(10):
+                    log.write(str(i).encode('ascii') * 60)
+            # only current file and two backups are kept
+            self.assertEqual(log.tail(1000), b'7' * 60 + b'8' * 60 + b'9' * 60)
+            self.assertEqual(log.tail(90), b'8' * 30 + b'9' * 60)
+            log.delete()
+            self.assertEqual(log.tail(), b'')
+
+
 class FelisMiscTests(TestCase):
 
     fixtures = ['felis1.json']
@@ -91,6 +697,50 @@ class FelisMiscTests(TestCase):
         with open(s.authkeyfile, 'r') as fh:
             self.assertEqual(u.prefrences.ssh_pubkey, fh.readline())
 
+    def test_jail_detail_page(self):
+        from django.urls import reverse
+        jail = Jail.objects.first()
+        response = self.client.get(reverse('jail', args=[jail.pk]), {'window': '7d'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '?window=7d')
+
+    def test_chart_conditional_get(self):
+        from django.urls import reverse
+        jail = Jail.objects.first()
+        RctlSample.objects.create(jail=jail, rctl_memoryuse=4096)
+        RctlSample.cache.delete(RctlSample.latest_key(jail.pk))
+        url = reverse('rctl_chart', args=[jail.pk, 'memoryuse']) + '?window=24h'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        # a new sample changes the key
+        sample = RctlSample.objects.create(jail=jail, rctl_memoryuse=8192)
+        RctlSample.cache.set(RctlSample.latest_key(jail.pk), sample.created)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_batched_metrics(self):
+        import json
+        from django.test import RequestFactory
+        from django.contrib.auth import get_user_model
+        from django.contrib.auth.models import AnonymousUser
+        from felis.views import MetricsView
+        jails = list(Jail.objects.all()[:2])
+        for jail in jails:
+            sample = RctlSample.objects.create(jail=jail, rctl_memoryuse=4096, rctl_maxproc=10)
+            RctlSample.cache.set(RctlSample.latest_key(jail.pk), sample.created)
+        request = RequestFactory().get('/metrics', {
+            'jail': [jail.pk for jail in jails], 'resource': ['memoryuse', 'maxproc'], 'window': '7d'})
+        request.user = AnonymousUser()
+        self.assertEqual(MetricsView.as_view()(request).status_code, 302)
+        request.user = get_user_model().objects.get(username='felis')  # from fixtures
+        # one query for samples of all jails and one for their rules
+        with self.assertNumQueries(2):
+            response = MetricsView.as_view()(request)
+        data = json.loads(response.content.decode('utf-8'))
+        self.assertEqual(set(data['jails']), {str(jail.pk) for jail in jails})
+        self.assertEqual(data['jails'][str(jails[0].pk)]['memoryuse']['v'], [4096])
+        self.assertEqual(len(data['jails'][str(jails[0].pk)]['maxproc']['t']), 1)
+
 # class FelisTests(TestCase):
 #     fixtures = ['felis.json']
 #
@@ -53,7 +53,12 @@ urlpatterns = [
     url(r'^jail/', JailListView.as_view(), name='jails'),
 
     # Transactions
+    url(r'^transactions/(?P<pk>\d+)/log', TransactionLogView.as_view(), name='transaction_log'),
+    url(r'^transactions/(?P<pk>\d+)/cancel', TransactionCancelView.as_view(), name='transaction_cancel'),
     url(r'^transactions', TransactionListView.as_view(), name='transactions'),
+    url(r'^changesets/(?P<pk>\d+)', ChangesetProgressView.as_view(), name='changeset'),
+    url(r'^metrics', MetricsView.as_view(), name='metrics'),
+    url(r'^fleet/', FleetView.as_view(), name='fleet'),
 
     # Charts
     url(r'^chart/(?P<pk>\d+)/rctl_iochart', RctlIOChartView.as_view(), name='rctl_io_chart'),
@@ -3,6 +3,7 @@ import string
 import subprocess
 import shlex
 from django_q.tasks import async
+from django.db.models import Case, When, Value, F
 from felis.errors import *
 
 
@@ -46,6 +47,10 @@ def render_command(model, command):
         })
 
 def run_shell_command(command, sudo=True, **kwargs):
+    if sudo and not kwargs:
+        # privileged commands are run by configured executor, see felis.executor
+        from felis.executor import get_executor
+        return get_executor().run(shlex.split(command))
     if sudo:
         sudo_cmd = ['sudo']
     else:
@@ -61,6 +66,28 @@ def run_shell_command(command, sudo=True, **kwargs):
         return p.returncode, stdout, stderr
 
 
+def bulk_update(model, rows, fields, batch_size=200):
+    """
+    Updates `fields' of many rows with one UPDATE per `batch_size' rows by means of CASE WHEN expressions.
+    `rows' is a dict of {pk: {field: value}}, fields missing in a row's dict are left unchanged.
+    Signals are not sent.
+    """
+    pks = list(rows.keys())
+    for i in range(0, len(pks), batch_size):
+        batch = pks[i:i + batch_size]
+        values = dict()
+        for field in fields:
+            whens = [
+                When(pk=pk, then=Value(rows[pk][field]))
+                for pk in batch
+                if field in rows[pk]
+            ]
+            if whens:
+                values[field] = Case(*whens, default=F(field), output_field=model._meta.get_field(field))
+        if values:
+            model.objects.filter(pk__in=batch).update(**values)
+
+
 
 # def sort_by_priority(itemset, limit):
 #     """
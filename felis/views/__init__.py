@@ -19,6 +19,7 @@ from .errorlog import *
 from .jail import *
 from .filesystem import *
 from .api import *
+from .fleet import *
 
 
 logger = logging.getLogger(__name__)
@@ -1,16 +1,131 @@
 # -*- coding: utf-8 -*-
 
+import json
+import hashlib
+from abc import ABC, abstractmethod
 from datetime import timedelta
+from collections import defaultdict
 from django.utils import timezone
 from django import http
+from django.core.cache import caches
 from django.views.generic import View
+from django.views.decorators.http import condition
+from django.utils.decorators import method_decorator
+from django.contrib.auth.decorators import login_required
+from django.conf import settings
+from django.contrib.postgres.fields.jsonb import KeyTransform
 from felis.models import *
+from felis.models.rctl import rctls
+from felis.downsample import downsample, METHODS
 
-__all__ = ['ChartView', 'RctlChartView', 'RctlIOChartView', 'FSChartView', 'FSDiagramView']
+__all__ = ['ChartView', 'RctlChartView', 'RctlIOChartView', 'FSChartView', 'FSDiagramView', 'MetricsView']
 
-class ChartView(View):
 
-    def get(self, request, pk, attribute, **kwargs):
+def transaction_series(instance, attributes, since):
+    """
+    Returns dict of {attribute: list of (created, value)} of values of `attributes' stored in transactions of
+    `instance' since `since'. Values are extracted from JSON by database in one query, only rows having
+    any of the keys are read (with help of GIN index on `value').
+    """
+    rows = Transaction.objects.filter(
+        instance=instance,
+        created__gt=since,
+        value__has_any_keys=list(attributes),
+    ).annotate(**{
+        'series_' + attribute: KeyTransform(attribute, 'value') for attribute in attributes
+    }).order_by('id').values_list('created', *['series_' + attribute for attribute in attributes])
+    series = {attribute: list() for attribute in attributes}
+    for created, *values in rows:
+        for attribute, value in zip(attributes, values):
+            if value is not None:
+                series[attribute].append((created, value))
+    return series
+
+
+# time windows selectable with `?window=' parameter of charts
+WINDOWS = {
+    '1h': timedelta(hours=1),
+    '3h': timedelta(hours=3),
+    '6h': timedelta(hours=6),
+    '24h': timedelta(hours=24),
+    '7d': timedelta(days=7),
+    '30d': timedelta(days=30),
+}
+
+
+class ChartWindowMixin(ABC):
+    """
+    Time window and number of points of a chart taken from request's `?window=6h|24h|7d|30d&points=N&method=lttb|minmax'.
+    Series longer than `points' are downsampled before rendering (see :mod:`felis.downsample`), so a chart of
+    a month renders as fast as a chart of an hour.
+
+    Rendered SVG is cached and keyed by view, its arguments, parameters above and time of the latest change of
+    charted data returned by `latest', so it is rendered again only when new data arrives. The same key is sent
+    as ETag along with Last-Modified, so charts embedded in pages left open are answered with 304.
+    """
+    default_window = '6h'
+    default_method = 'lttb'
+    content_type = 'image/svg+xml'
+
+    def dispatch(self, request, *args, **kwargs):
+        window = request.GET.get('window', self.default_window)
+        method = request.GET.get('method', self.default_method)
+        try:
+            points = int(request.GET.get('points', settings.FELIS_CHART_POINTS))
+        except ValueError:
+            return http.HttpResponseBadRequest("Parameter `points' must be an integer")
+        if window not in WINDOWS:
+            return http.HttpResponseBadRequest("Unknown window `{0}'".format(window))
+        if method not in METHODS:
+            return http.HttpResponseBadRequest("Unknown downsampling method `{0}'".format(method))
+        self.window = WINDOWS[window]
+        self.points = max(4, min(points, settings.FELIS_CHART_MAX_POINTS))
+        self.method = method
+        self.now = timezone.now()
+
+        self.last_modified = self.latest(*args, **kwargs)
+        self.etag = hashlib.sha1(':'.join([
+            type(self).__name__,
+            *('{0}={1}'.format(k, kwargs[k]) for k in sorted(kwargs)),
+            *('{0}={1}'.format(k, v) for k, v in sorted(request.GET.lists()) if k not in ('window', 'points', 'method')),
+            window, str(self.points), method,
+            self.last_modified.isoformat() if self.last_modified else '',
+        ]).encode('utf-8')).hexdigest()
+        return condition(
+            etag_func=lambda request, *args, **kwargs: self.etag,
+            last_modified_func=lambda request, *args, **kwargs: self.last_modified,
+        )(super().dispatch)(request, *args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        cache = caches['chart']
+        key = 'chart:' + self.etag
+        svg = cache.get(key, None)
+        if svg is None:
+            svg = self.render(*args, **kwargs)
+            cache.set(key, svg)
+        return http.HttpResponse(svg, content_type=self.content_type)
+
+    def latest(self, pk, **kwargs):
+        """Returns time of the latest change of charted data, by default the latest transaction of instance"""
+        return Transaction.objects.filter(
+            instance_id=pk
+        ).order_by('-created').values_list('created', flat=True).first()
+
+    @abstractmethod
+    def render(self, *args, **kwargs):
+        """Returns rendered chart, called with arguments of the view only when it is not cached"""
+
+    @property
+    def since(self):
+        return self.now - self.window
+
+    def downsample(self, dots):
+        return downsample(dots, self.points, self.method)
+
+
+class ChartView(ChartWindowMixin, View):
+
+    def render(self, pk, attribute, **kwargs):
         import pygal
         from pygal.style import DarkSolarizedStyle
         object = Model.objects.get(pk=pk)
@@ -18,23 +133,18 @@ class ChartView(View):
             x_label_rotation=35, truncate_label=-1, style=DarkSolarizedStyle,
             x_value_formatter=lambda dt: dt.strftime('%d, %b %Y at %I:%M:%S %p'),
         )
-        dots = [
-            (i.created, i.value[attribute])
-            for i
-            in Transaction.objects.filter(
-                instance=object,
-                created__gt=timezone.now() - timedelta(hours=6)
-            ).order_by('id')
-            if hasattr(i, 'value') and attribute in i.value and i.value[attribute] is not None
-            ]
-        dots.append((timezone.now(), object.as_dict()[attribute]))
+        dots = self.downsample(transaction_series(object, [attribute], self.since)[attribute])
+        dots.append((self.now, object.as_dict()[attribute]))
         chartline.add(attribute, dots)
-        return http.HttpResponse(chartline.render(), content_type='image/svg+xml')
+        return chartline.render()
 
 
-class RctlChartView(View):
+class RctlChartView(ChartWindowMixin, View):
 
-    def get(self, request, pk, attribute, **kwargs):
+    def latest(self, pk, **kwargs):
+        return RctlSample.latest(pk)
+
+    def render(self, pk, attribute, **kwargs):
         import pygal
         from pygal.style import DarkSolarizedStyle
 
@@ -44,27 +154,31 @@ class RctlChartView(View):
             x_value_formatter=lambda dt: dt.strftime('%d, %b %Y at %I:%M:%S %p'),
         )
         fieldname = 'rctl_' + attribute
-        dots = [
-            (i.created, i.value[fieldname])
-            for i
-            in Transaction.objects.filter(
-                instance=object,
-                created__gt=timezone.now() - timedelta(hours=6)
-            ).order_by('id')
-            if (fieldname in i.value) and (i.value[fieldname] is not None)
-            ]
-        dots.append((timezone.now(), object.as_dict()[fieldname]))
+        dots = self.downsample([
+            (created, value)
+            for created, value
+            in RctlSample.objects.filter(
+                jail_id=object.pk,
+                created__gt=self.since
+            ).order_by('created').values_list('created', fieldname)
+            if value is not None
+            ])
+        dots.append((self.now, object.as_dict()[fieldname]))
         chartline.add(attribute, dots)
         for rule in RctlRule.objects.filter(jail=object, resource=attribute).all():
             chartline.add(
-                rule.action,[(timezone.now()-timedelta(hours=6), rule.amount), (timezone.now(), rule.amount)]
+                rule.action,[(self.since, rule.amount), (self.now, rule.amount)]
             )
-        return http.HttpResponse(chartline.render(), content_type='image/svg+xml')
+        return chartline.render()
 
 
-class RctlIOChartView(View):
+class RctlIOChartView(ChartWindowMixin, View):
+    default_window = '1h'
 
-    def get(self, request, pk, **kwargs):
+    def latest(self, pk, **kwargs):
+        return RctlSample.latest(pk)
+
+    def render(self, pk, **kwargs):
         import pygal
         from pygal.style import DarkSolarizedStyle
 
@@ -75,18 +189,20 @@ class RctlIOChartView(View):
             # interpolate='hermite', interpolation_parameters={'type': 'cardinal', 'c': 0.75},
             legend_at_bottom=True, dots_size=1
         )
-        for attribute in ['readbps', 'writebps', 'readiops', 'writeiops']:
+        attributes = ['readbps', 'writebps', 'readiops', 'writeiops']
+        samples = list(RctlSample.objects.filter(
+            jail_id=object.pk,
+            created__gt=self.since
+        ).order_by('created').values_list('created', *['rctl_' + i for i in attributes]))
+        for n, attribute in enumerate(attributes, 1):
             fieldname = 'rctl_' + attribute
-            dots = [
-                (i.created, i.new_values_dict[fieldname])
-                for i
-                in Transaction.objects.filter(
-                    instance=object,
-                    created__gt=timezone.now() - timedelta(hours=1)
-                ).order_by('id')
-                if (fieldname in i.new_values_dict) and (i.new_values_dict[fieldname] is not None)
-                ]
-            dots.append((timezone.now(), object.as_dict()[fieldname]))
+            dots = self.downsample([
+                (sample[0], sample[n])
+                for sample
+                in samples
+                if sample[n] is not None
+                ])
+            dots.append((self.now, object.as_dict()[fieldname]))
 
             if attribute.endswith('iops'):
                 secondary = True
@@ -97,14 +213,16 @@ class RctlIOChartView(View):
             for rule in RctlRule.objects.filter(jail=object, resource=attribute).all():
                 chartline.add(
                     attribute+' '+rule.action,
-                    [(timezone.now()-timedelta(hours=1), rule.amount), (timezone.now(), rule.amount)],
+                    [(self.since, rule.amount), (self.now, rule.amount)],
                     secondary=secondary
                 )
-        return http.HttpResponse(chartline.render(), content_type='image/svg+xml')
+        return chartline.render()
 
-class FSChartView(View):
 
-    def get(self, request, pk, **kwargs):
+class FSChartView(ChartWindowMixin, View):
+    default_window = '3h'
+
+    def render(self, pk, **kwargs):
         import pygal
         from pygal.style import DarkSolarizedStyle
         chartline = pygal.DateTimeLine(
@@ -114,40 +232,15 @@ class FSChartView(View):
         )
         object = Model.objects.get(pk=pk)
 
-        used = [
-            (i.created, i.value['used'])
-            for i
-            in Transaction.objects.filter(
-                instance=object,
-                created__gt=timezone.now() - timedelta(hours=3)
-            ).order_by('id')
-            if hasattr(i, 'value') and 'used' in i.value and i.value['used'] is not None
-            ]
-        used.append((timezone.now(), object.used))
-        avail = [
-            (i.created, i.value['avail'])
-            for i
-            in Transaction.objects.filter(
-                instance=object,
-                created__gt=timezone.now() - timedelta(hours=3)
-            ).order_by('id')
-            if hasattr(i, 'value') and 'avail' in i.value and i.value['avail'] is not None
-            ]
-        avail.append((timezone.now(), object.avail))
-        refer = [
-            (i.created, i.value['refer'])
-            for i
-            in Transaction.objects.filter(
-                instance=object,
-                created__gt=timezone.now() - timedelta(hours=3)
-            ).order_by('id')
-            if hasattr(i, 'value') and 'refer' in i.value and i.value['refer'] is not None
-            ]
-        refer.append((timezone.now(), object.refer))
+        series = transaction_series(object, ['used', 'avail', 'refer'], self.since)
+        used, avail, refer = [self.downsample(series[attribute]) for attribute in ('used', 'avail', 'refer')]
+        used.append((self.now, object.used))
+        avail.append((self.now, object.avail))
+        refer.append((self.now, object.refer))
         chartline.add('USED', used, fill=True)
         chartline.add('AVAIL', avail, fill=True)
         chartline.add('REFER', refer, fill=True)
-        return http.HttpResponse(chartline.render(), content_type='image/svg+xml')
+        return chartline.render()
 
 class FSDiagramView(View):
 
@@ -163,3 +256,67 @@ class FSDiagramView(View):
         diagram.add('AVAIL', object.avail)
         return http.HttpResponse(diagram.render(), content_type='image/svg+xml')
 
+
+class MetricsView(ChartWindowMixin, View):
+    """
+    Resource usage of one or more jails as JSON, e.g. `?jail=1&jail=2&resource=memoryuse&window=24h'
+    (all resources by default). Series are columnar: {"t": [unix timestamps], "v": [values]}, downsampled like
+    charts, along with rctl rules of the resource. All series are read with one query and all rules with another,
+    so a dashboard may fetch everything it draws in a single request.
+    """
+    content_type = 'application/json'
+
+    @method_decorator(login_required)
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            self.jail_ids = sorted({int(pk) for pk in request.GET.getlist('jail')})
+        except ValueError:
+            return http.HttpResponseBadRequest("Parameter `jail' must be an integer")
+        if not self.jail_ids:
+            return http.HttpResponseBadRequest("At least one `jail' parameter is required")
+        known = [rctl[0] for rctl in rctls]
+        self.resources = request.GET.getlist('resource') or known
+        unknown = set(self.resources) - set(known)
+        if unknown:
+            return http.HttpResponseBadRequest("Unknown resources: {0}".format(', '.join(sorted(unknown))))
+        return super().dispatch(request, *args, **kwargs)
+
+    def latest(self, **kwargs):
+        keys = {RctlSample.latest_key(pk): pk for pk in self.jail_ids}
+        cached = RctlSample.cache.get_many(list(keys))
+        times = [cached.get(key, None) or RctlSample.latest(pk) for key, pk in keys.items()]
+        return max((t for t in times if t is not None), default=None)
+
+    def render(self, **kwargs):
+        samples = defaultdict(list)
+        for jail_id, created, *values in RctlSample.objects.filter(
+                jail_id__in=self.jail_ids,
+                created__gt=self.since,
+        ).order_by('jail_id', 'created').values_list(
+            'jail_id', 'created', *['rctl_' + resource for resource in self.resources]
+        ):
+            samples[jail_id].append((created, values))
+
+        rules = defaultdict(list)
+        for jail_id, resource, action, amount, per in RctlRule.objects.filter(
+                jail_id__in=self.jail_ids,
+                resource__in=self.resources,
+        ).order_by('pk').values_list('jail_id', 'resource', 'action', 'amount', 'per'):
+            rules[(jail_id, resource)].append({'action': action, 'amount': amount, 'per': per})
+
+        jails = dict()
+        for jail_id in self.jail_ids:
+            jails[str(jail_id)] = series = dict()
+            for n, resource in enumerate(self.resources):
+                dots = self.downsample([
+                    (created, values[n]) for created, values in samples[jail_id] if values[n] is not None])
+                series[resource] = {
+                    't': [int(created.timestamp()) for created, _value in dots],
+                    'v': [value for _created, value in dots],
+                    'rules': rules[(jail_id, resource)],
+                }
+        return json.dumps({
+            'since': int(self.since.timestamp()),
+            'until': int(self.now.timestamp()),
+            'jails': jails,
+        })
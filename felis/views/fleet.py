@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from django.views.generic import TemplateView
+from django.utils.decorators import method_decorator
+from django.contrib.auth.decorators import login_required
+from felis.models import FleetSnapshot
+from felis.models.rctl import rctls
+
+__all__ = ['FleetView']
+
+
+class FleetView(TemplateView):
+    """
+    Overview of resource usage of all running jails. Everything is read from the latest :model:`felis.FleetSnapshot`
+    with a single query, as aggregates are computed when usage is collected.
+    """
+    template_name = 'fleet.html'
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super(FleetView, self).dispatch(*args, **kwargs)
+
+    def get_context_data(self, **kwargs):
+        context = super(FleetView, self).get_context_data(**kwargs)
+        resources = [rctl[0] for rctl in rctls]
+        selected = [r for r in self.request.GET.getlist('resource') if r in resources] or \
+            ['pcpu', 'memoryuse', 'writebps', 'readbps']
+        snapshot = FleetSnapshot.current()
+        context['snapshot'] = snapshot
+        context['resources'] = selected
+        context['all_resources'] = resources
+        if snapshot is not None:
+            data = snapshot.data
+            context['jails'] = data['jails']
+            context['host'] = [(r, data['host'].get(r, 0)) for r in selected]
+            context['top'] = [(r, data['top'].get(r, [])) for r in selected]
+            context['skels'] = [
+                dict(group, totals=[group['totals'].get(r, 0) for r in selected]) for group in data['skels']]
+            context['worlds'] = [
+                dict(group, totals=[group['totals'].get(r, 0) for r in selected]) for group in data['worlds']]
+        return context
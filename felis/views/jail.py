@@ -36,6 +36,7 @@ class JailDetailView(DetailView):
         context = super(JailDetailView, self).get_context_data(**kwargs)
         context['ssh'] = 'ssh felis@'+self.request.get_host()+' -p'+str(50000+self.object.id)
         context['charts'] = [i[0] for i in rctls]
+        context['chart_windows'] = ['6h', '24h', '7d', '30d']
         return context
 
 
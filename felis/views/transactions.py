@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 
 from django.db.models import Q
-from django.views.generic import ListView
-from felis.models import Transaction
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import redirect
+from django.views.generic import ListView, DetailView
+from django.utils.decorators import method_decorator
+from django.contrib.auth.decorators import login_required
+from felis.models import Transaction, Changeset
 from .pagination import PaginationMixin
 
-__all__ = ['TransactionListView']
+__all__ = ['TransactionListView', 'TransactionLogView', 'TransactionCancelView', 'ChangesetProgressView']
 
 class TransactionListView(ListView, PaginationMixin):
     model = Transaction
@@ -22,3 +26,55 @@ class TransactionListView(ListView, PaginationMixin):
         context_data = super(TransactionListView, self).get_context_data(**kwargs)
         context_data['show_system'] = self.request.GET.get('show_system', None)
         return self.add_paginator(context_data)
+
+
+class TransactionLogView(DetailView):
+    """
+    Returns last `bytes' (64KiB by default) bytes of output of transaction's task as plain text.
+    """
+    model = Transaction
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super(TransactionLogView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        transaction = self.get_object()
+        try:
+            size = max(0, int(request.GET.get('bytes', 64 * 1024)))
+        except ValueError:
+            size = 64 * 1024
+        return HttpResponse(transaction.log.tail(size), content_type='text/plain; charset=utf-8')
+
+
+class TransactionCancelView(DetailView):
+    """Kills running command of transaction's task, accepts POST only so it is protected by CSRF middleware"""
+    model = Transaction
+    http_method_names = ['post']
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super(TransactionCancelView, self).dispatch(*args, **kwargs)
+
+    def post(self, request, *args, **kwargs):
+        self.get_object().cancel()
+        return redirect('transactions')
+
+
+class ChangesetProgressView(DetailView):
+    """Returns numbers of changeset's transactions by their state as JSON"""
+    model = Changeset
+
+    @method_decorator(login_required)
+    def dispatch(self, *args, **kwargs):
+        return super(ChangesetProgressView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        changeset = self.get_object()
+        return JsonResponse({
+            'id': changeset.pk,
+            'description': changeset.description,
+            'created': changeset.created,
+            'author': changeset.author_id,
+            'progress': changeset.progress,
+        })